@@ -1,50 +1,712 @@
+import csv
+import gzip
+import io
 import json
 import os
 import re
+import shutil
 from datetime import datetime
-
-from pandas import ExcelWriter
-from pandas.io.json import json_normalize
+from time import perf_counter
+from urllib.parse import quote
 
 import scripts.logger_util as Logger
-from scripts.utils import get_configuration
+from scripts.metrics import record_write
+from scripts.utils import get_configuration, register_process_state
 
 logger = Logger.get_logger(__name__)
 config = get_configuration()
 
+PARTITIONED_FORMATS = ('parquet', 'arrow')
+COMPRESSIONS = ('gzip', 'zstd')
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+
+_compression = None
+_compression_level = None
+# Uncompressed size of every file closed by _CompressedFile in this process, until its write is recorded
+_uncompressed_sizes = {}
+
+
+def set_compression(compression, level=None):
+    """
+    Compress the json / csv / delta files of this process and of the writer processes started after this call while
+    they are written. Parquet and arrow compress their column chunks / record batches with the codec instead.
+    """
+    global _compression, _compression_level
+    _compression = compression if compression in COMPRESSIONS else None
+    _compression_level = level if level is not None else DEFAULT_COMPRESSION_LEVELS.get(_compression)
+    if _compression == 'zstd' and level is not None and not _has_zstandard():
+        logger.warning('zstandard is not installed, zstd output uses the default level of pyarrow')
+
+
+def _get_compression():
+    return _compression, _compression_level
+
+
+def _set_compression(state):
+    global _compression, _compression_level
+    _compression, _compression_level = state
+
+
+register_process_state(__name__, _get_compression, _set_compression)
+
+
+def is_compression_available(compression):
+    if compression != 'zstd' or _has_zstandard():
+        return True
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return False
+    return pa.Codec.is_available('zstd')
+
 
 def write_to_file(market_type, category, data, output_format):
     start_time = datetime.now()
     logger.info(
         "Saving {} -> {} data in {} format, started at {}".format(market_type, category, output_format, start_time))
-    file_dir = config['DOWNLOAD_LOCATION'] + market_type
-    _create_directory(file_dir)
-
     category_with_out_special_chars = re.sub('[^a-zA-Z0-9]+', ' ', category)
-    base_file_name = file_dir + '/' + category_with_out_special_chars
+    base_file_name = _get_base_file_name(market_type, category)
 
     if output_format == 'json':
-        file_name = base_file_name + '.json'
+        file_name = _get_output_file_name(base_file_name + '.json')
         _write_json_data(file_name, data)
     elif output_format == 'csv':
-        file_name = base_file_name + '.json'
+        file_name = _get_output_file_name(base_file_name + '.csv')
         _write_csv_data(file_name, data)
+    elif output_format in PARTITIONED_FORMATS:
+        file_name = _get_partition_file_name(market_type, category, output_format)
+        _write_arrow_data(file_name, data, output_format)
     else:
         file_name = base_file_name + ".xlsx"
         _write_excel_data(file_name, category_with_out_special_chars, data)
 
     completed_time = datetime.now()
+    _record_write(output_format, file_name, (completed_time - start_time).total_seconds())
     logger.info("Successfully saved {} -> {} data into {} file, completed at {}, total time - {}"
                 .format(market_type, category, file_name, completed_time, completed_time - start_time))
 
 
+def write_delta_file(market_type, category, delta):
+    """
+    Write the added / changed / removed items of an incremental crawl next to the category output.
+    """
+    file_name = _get_output_file_name(_get_base_file_name(market_type, category) + '.delta.json')
+    with _open_output(file_name) as file:
+        json.dump(delta, file)
+    # The delta is not a write of the output format, its sizes are only logged
+    _uncompressed_sizes.pop(file_name, None)
+    logger.info("Saved {} -> {} delta into {} file, {} added, {} changed, {} removed"
+                .format(market_type, category, file_name, len(delta['Added']), len(delta['Changed']),
+                        len(delta['Removed'])))
+
+
+def open_stream_writer(market_type, category, output_format):
+    """
+    Open a per category file that items are appended to page by page, as NDJSON for json output, TSV for csv and
+    record batches for parquet / arrow.
+    """
+    base_file_name = _get_base_file_name(market_type, category)
+    if output_format == 'json':
+        return _TimedStreamWriter(_NdjsonStreamWriter(_get_output_file_name(base_file_name + '.ndjson')),
+                                  output_format)
+    elif output_format == 'csv':
+        return _TimedStreamWriter(_CsvStreamWriter(_get_output_file_name(base_file_name + '.csv')), output_format)
+    elif output_format in PARTITIONED_FORMATS:
+        return _TimedStreamWriter(_ArrowStreamWriter(_get_partition_file_name(market_type, category, output_format),
+                                                     output_format), output_format)
+    raise ValueError("Streaming is not supported for '{}' output format".format(output_format))
+
+
+def concatenate_stream_files(market_type, categories, output_format):
+    """
+    Build the consolidated market file from the stream files of the given categories, without loading them in memory.
+    Only categories written in this run, or in an earlier one as per checkpoint, should be given.
+    """
+    start_time = datetime.now()
+    extension = _get_output_file_name('.ndjson' if output_format == 'json' else '.csv')
+    file_name = _get_base_file_name(market_type, market_type) + extension
+    category_file_names = [_get_base_file_name(market_type, category) + extension for category in categories]
+    category_file_names = [f for f in category_file_names if f != file_name]
+    logger.info("Concatenating {} category files into {}, started at {}"
+                .format(len(category_file_names), file_name, start_time))
+
+    if output_format == 'json':
+        # gzip members and zstd frames can be concatenated as well, compressed files are copied without recompressing
+        with open(file_name, 'wb') as file:
+            for category_file_name in category_file_names:
+                with open(category_file_name, 'rb') as category_file:
+                    shutil.copyfileobj(category_file, file)
+    else:
+        _concatenate_csv_files(file_name, category_file_names)
+
+    completed_time = datetime.now()
+    _record_write(output_format, file_name, (completed_time - start_time).total_seconds())
+    logger.info("Successfully concatenated {} data into {} file, completed at {}, total time - {}"
+                .format(market_type, file_name, completed_time, completed_time - start_time))
+
+
+def write_consolidated_file(market_type, categories, output_format):
+    """
+    Build the consolidated market file from the category files written by write_to_file, one category in memory at a
+    time. The result is the same as write_to_file of the whole market. Only categories written in this run, or in an
+    earlier one as per checkpoint, should be given, a file left by an earlier run is not a sign of a written category.
+    """
+    start_time = datetime.now()
+    extension = {'json': _get_output_file_name('.json'), 'csv': _get_output_file_name('.csv'),
+                 'excel': '.xlsx'}[output_format]
+    file_name = _get_base_file_name(market_type, market_type) + extension
+    category_file_names = [_get_base_file_name(market_type, category) + extension for category in categories]
+    category_file_names = [f for f in category_file_names if f != file_name]
+    logger.info("Consolidating {} category files into {}, started at {}"
+                .format(len(category_file_names), file_name, start_time))
+
+    if output_format == 'json':
+        with _open_output(file_name) as file:
+            file.write('[{"Market": ' + json.dumps(market_type) + ', "Category": [')
+            for i, category_file_name in enumerate(category_file_names):
+                with _open_input(category_file_name) as category_file:
+                    category_data = json.load(category_file)
+                for j, category in enumerate(category_data['Category']):
+                    file.write(', ' if i or j else '')
+                    json.dump(category, file)
+            file.write(']}]')
+    elif output_format == 'csv':
+        # Category files come from pandas to_csv, which ends lines with \n
+        _concatenate_csv_files(file_name, category_file_names, '\n')
+    else:
+        from pandas import ExcelWriter, concat, read_excel
+        df = concat([read_excel(f, index_col=0) for f in category_file_names], ignore_index=True, sort=False)
+        writer = ExcelWriter(file_name)
+        df.to_excel(writer, re.sub('[^a-zA-Z0-9]+', ' ', market_type))
+        writer.save()
+
+    completed_time = datetime.now()
+    _record_write(output_format, file_name, (completed_time - start_time).total_seconds())
+    logger.info("Successfully consolidated {} data into {} file, completed at {}, total time - {}"
+                .format(market_type, file_name, completed_time, completed_time - start_time))
+
+
+def write_partition_part(market_type, category, part_name, meta, items, output_format):
+    """
+    Write one page of items as its own part file of the Market/CategoryName partitioned dataset, used by the
+    distributed workers. The part is written under a temporary name and renamed, so a page that is crawled again after
+    a lost lease just replaces its part.
+    """
+    start_time = perf_counter()
+    partition_dir = _get_partition_dir(market_type, category, output_format)
+    extension = {'json': 'ndjson', 'csv': 'csv'}.get(output_format, output_format)
+    file_name = _get_output_file_name(partition_dir + '/part-' + part_name + '.' + extension)
+    temp_file_name = partition_dir + '/.part-' + part_name + '.' + str(os.getpid()) + '.tmp'
+    if output_format == 'json':
+        writer = _NdjsonStreamWriter(temp_file_name)
+    elif output_format == 'csv':
+        writer = _CsvStreamWriter(temp_file_name)
+    elif output_format in PARTITIONED_FORMATS:
+        writer = _ArrowStreamWriter(temp_file_name, output_format)
+    else:
+        raise ValueError("Partitioned parts are not supported for '{}' output format".format(output_format))
+    writer.write_items(meta, items)
+    writer.close()
+    if os.path.exists(temp_file_name):
+        os.replace(temp_file_name, file_name)
+    if temp_file_name in _uncompressed_sizes:
+        _uncompressed_sizes[file_name] = _uncompressed_sizes.pop(temp_file_name)
+    _record_write(output_format, file_name, perf_counter() - start_time)
+    return file_name
+
+
+def remove_partitions(market_type, output_format):
+    partition_root = config['DOWNLOAD_LOCATION'] + market_type + '/' + output_format
+    if os.path.exists(partition_root):
+        logger.info('Removing partitioned output of the previous run {}'.format(partition_root))
+        shutil.rmtree(partition_root)
+
+
+class _TimedStreamWriter:
+    # Counts the time spent in a stream writer and the size of its file into the write metrics of the output format
+    def __init__(self, writer, output_format):
+        self.file_name = writer.file_name
+        self.__writer = writer
+        self.__output_format = output_format
+        self.__write_seconds = 0.0
+
+    def write_items(self, meta, items):
+        start_time = perf_counter()
+        self.__writer.write_items(meta, items)
+        self.__write_seconds += perf_counter() - start_time
+
+    def close(self):
+        start_time = perf_counter()
+        self.__writer.close()
+        _record_write(self.__output_format, self.file_name, self.__write_seconds + perf_counter() - start_time)
+
+
+class _NdjsonStreamWriter:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.__file = _open_output(file_name)
+
+    def write_items(self, meta, items):
+        for item in items:
+            row = dict(meta)
+            row.update(item)
+            self.__file.write(json.dumps(row))
+            self.__file.write('\n')
+
+    def close(self):
+        self.__file.close()
+
+
+class _CsvStreamWriter:
+    # Columns that first appear on a later page are appended to the rows as they come, the header line is rewritten
+    # with them on close, so the file has the columns of the non streamed output in the same order
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.__file = _open_output(file_name, newline='')
+        self.__writer = None
+        self.__header = []
+        self.__columns = set()
+        self.__header_length = 0
+
+    def write_items(self, meta, items):
+        rows = [_flatten_item(dict(meta), item) for item in items]
+        if not rows:
+            return
+        for row in rows:
+            for column in row:
+                if column not in self.__columns:
+                    self.__header.append(column)
+                    self.__columns.add(column)
+        if self.__writer is None:
+            self.__writer = csv.DictWriter(self.__file, fieldnames=list(self.__header), delimiter='\t')
+            self.__writer.writeheader()
+            self.__header_length = len(self.__header)
+        elif len(self.__header) > len(self.__writer.fieldnames):
+            self.__writer.fieldnames = list(self.__header)
+        self.__writer.writerows(rows)
+
+    def close(self):
+        self.__file.close()
+        if len(self.__header) > self.__header_length:
+            self.__rewrite_header()
+
+    def __rewrite_header(self):
+        logger.info("Columns {} came after the header of {} was written, rewriting it with {} columns"
+                    .format(', '.join(self.__header[self.__header_length:]), self.file_name, len(self.__header)))
+        temp_file_name = self.file_name + '.tmp'
+        with _open_input(self.file_name, newline='') as source, \
+                _open_output(temp_file_name, newline='') as file:
+            reader = csv.reader(source, delimiter='\t')
+            next(reader)
+            writer = csv.writer(file, delimiter='\t')
+            writer.writerow(self.__header)
+            # Rows written before a column appeared end before it, they are padded with empty values
+            for row in reader:
+                writer.writerow(row + [''] * (len(self.__header) - len(row)))
+        os.replace(temp_file_name, self.file_name)
+        if temp_file_name in _uncompressed_sizes:
+            _uncompressed_sizes[self.file_name] = _uncompressed_sizes.pop(temp_file_name)
+
+
+class _ArrowStreamWriter:
+    """
+    Pages are written as record batches as they arrive, no more than one page is held in memory. The schema widens as
+    pages arrive, a column that first appears on a later page is added, int64 values next to doubles become doubles,
+    and a column whose values do not fit one type is stored as text. No value is truncated or dropped.
+
+    A page that widens the schema closes the current file and continues in the next part file of the partition. Parts
+    written before a column changed its type are rewritten batch by batch with the new type, so the parts only differ
+    in the columns they lack. On close the last part, which has every column, takes the file name of the writer, so
+    readers taking the schema of the dataset from its first file see every column.
+    """
+
+    def __init__(self, file_name, output_format):
+        self.file_name = file_name
+        self.file_names = []
+        self.__output_format = output_format
+        self.__writer = None
+        self.__schema = None
+        self.__text_columns = set()
+
+    def write_items(self, meta, items):
+        rows = [_flatten_item(dict(meta), item) for item in items]
+        if not rows:
+            return
+        page, text_columns = _get_record_batch(rows)
+        for column in set(text_columns) - self.__text_columns:
+            logger.warning("Column {} of {} mixes types on one page, storing it as text".format(column, self.file_name))
+            self.__text_columns.add(column)
+        schema, batch = self.__cast_batch(page, self.__get_schema(page))
+        if self.__writer is None or not schema.equals(self.__schema):
+            schema = self.__open_part(schema)
+            if not schema.equals(batch.schema):
+                # Columns of the earlier parts turned to text, the page follows them
+                schema, batch = self.__cast_batch(page, schema)
+        self.__writer.write_batch(batch)
+
+    def close(self):
+        if self.__writer is None:
+            return
+        self.__writer.close()
+        self.__writer = None
+        if len(self.file_names) > 1:
+            self.__rename_parts()
+            # The first file is counted by the caller of the writer, the other parts only add their size
+            for file_name in self.file_names[1:]:
+                _record_write(self.__output_format, file_name, None)
+
+    def __open_part(self, schema):
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+            schema = self.__cast_parts(schema)
+            logger.info("Schema of {} widened to {} columns, continuing in the next part file"
+                        .format(self.file_name, len(schema)))
+        file_name = _get_part_file_name(self.file_name, len(self.file_names))
+        self.__writer = _open_arrow_writer(file_name, schema, self.__output_format)
+        self.__schema = schema
+        self.file_names.append(file_name)
+        return schema
+
+    def __get_schema(self, batch):
+        # Schema of the current part widened by the page, columns keep the order they first appeared in
+        import pyarrow as pa
+
+        fields = list(self.__schema) if self.__schema is not None else []
+        positions = dict((field.name, i) for i, field in enumerate(fields))
+        for field in batch.schema:
+            if field.name in positions:
+                i = positions[field.name]
+                fields[i] = pa.field(field.name, self.__unify_types(field.name, fields[i].type, field.type))
+            else:
+                positions[field.name] = len(fields)
+                fields.append(field)
+        return pa.schema(fields)
+
+    def __unify_types(self, name, value_type, page_type):
+        import pyarrow as pa
+
+        if value_type == page_type:
+            return value_type
+        try:
+            return pa.unify_schemas([pa.schema([(name, value_type)]), pa.schema([(name, page_type)])],
+                                    promote_options='permissive').field(name).type
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            if name not in self.__text_columns:
+                logger.warning("Column {} of {} has {} and {} values, storing it as text"
+                               .format(name, self.file_name, value_type, page_type))
+                self.__text_columns.add(name)
+            return pa.string()
+
+    def __cast_batch(self, batch, schema):
+        # The page cast to the schema, a column whose values do not survive the cast is stored as text from now on
+        import pyarrow as pa
+
+        columns = []
+        for i, field in enumerate(schema):
+            try:
+                columns.append(_cast_column(batch, field.name, field.type))
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+                logger.warning("Column {} of {} does not fit {}, storing it as text. Error - {}"
+                               .format(field.name, self.file_name, field.type, str(e)))
+                self.__text_columns.add(field.name)
+                schema = schema.set(i, pa.field(field.name, pa.string()))
+                columns.append(_get_text_column(batch, field.name))
+        return schema, pa.RecordBatch.from_arrays(columns, schema=schema)
+
+    def __cast_parts(self, schema):
+        """
+        Rewrite the closed parts with the types the schema changed. A column whose values in a part do not survive the
+        cast is stored as text in every part, returns the schema with those columns as text.
+        """
+        import pyarrow as pa
+
+        changed_columns = set(field.name for field in self.__schema
+                              if not pa.types.is_null(field.type) and field.type != schema.field(field.name).type)
+        while changed_columns:
+            text_columns = set()
+            for file_name in self.file_names:
+                text_columns.update(self.__cast_part(file_name, schema, changed_columns))
+            if not text_columns:
+                break
+            for name in text_columns:
+                self.__text_columns.add(name)
+                schema = schema.set(schema.get_field_index(name), pa.field(name, pa.string()))
+        return schema
+
+    def __cast_part(self, file_name, schema, columns):
+        # Returns the columns that do not fit their new type, the part is left as it is when there are any
+        import pyarrow as pa
+
+        part_schema = _read_arrow_schema(file_name, self.__output_format)
+        for i, field in enumerate(part_schema):
+            if field.name in columns and not pa.types.is_null(field.type):
+                part_schema = part_schema.set(i, schema.field(field.name))
+        if part_schema.equals(_read_arrow_schema(file_name, self.__output_format)):
+            return set()
+        temp_file_name = file_name + '.tmp'
+        writer = _open_arrow_writer(temp_file_name, part_schema, self.__output_format)
+        try:
+            for batch in _get_arrow_batches(file_name, self.__output_format):
+                part_columns = []
+                for field in part_schema:
+                    if field.name in columns and pa.types.is_string(field.type):
+                        part_columns.append(_get_text_column(batch, field.name))
+                        continue
+                    try:
+                        part_columns.append(_cast_column(batch, field.name, field.type))
+                    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+                        logger.warning("Column {} of {} does not fit {}, storing it as text. Error - {}"
+                                       .format(field.name, file_name, field.type, str(e)))
+                        writer.close()
+                        os.remove(temp_file_name)
+                        return {field.name}
+                writer.write_batch(pa.RecordBatch.from_arrays(part_columns, schema=part_schema))
+        except BaseException:
+            writer.close()
+            raise
+        writer.close()
+        os.replace(temp_file_name, file_name)
+        return set()
+
+    def __rename_parts(self):
+        # part-0 <- the last part, part-0_1 <- part-0, part-0_2 <- part-0_1 ...
+        temp_file_name = self.file_names[-1] + '.tmp'
+        os.replace(self.file_names[-1], temp_file_name)
+        for part in range(len(self.file_names) - 2, -1, -1):
+            os.replace(self.file_names[part], self.file_names[part + 1])
+        os.replace(temp_file_name, self.file_name)
+
+
+def _get_record_batch(rows):
+    """
+    Returns the record batch of one page with the types pyarrow infers per column, and the columns stored as text
+    because their values mix types.
+    """
+    import pyarrow as pa
+
+    names = {}
+    for row in rows:
+        for column in row:
+            names.setdefault(column, None)
+    columns = []
+    text_columns = []
+    for name in names:
+        values = [row.get(name) for row in rows]
+        try:
+            columns.append(pa.array(values))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            columns.append(pa.array([_to_text(value) for value in values], type=pa.string()))
+            text_columns.append(name)
+    return pa.RecordBatch.from_arrays(columns, names=list(names)), text_columns
+
+
+def _cast_column(batch, name, value_type):
+    import pyarrow as pa
+
+    if name not in batch.schema.names:
+        return pa.nulls(batch.num_rows, type=value_type)
+    column = batch.column(name)
+    return column if column.type == value_type else column.cast(value_type, safe=True)
+
+
+def _get_text_column(batch, name):
+    import pyarrow as pa
+
+    if name not in batch.schema.names:
+        return pa.nulls(batch.num_rows, type=pa.string())
+    column = batch.column(name)
+    try:
+        return column.cast(pa.string(), safe=True)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return pa.array([_to_text(value) for value in column.to_pylist()], type=pa.string())
+
+
+def _to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+
+def _read_arrow_schema(file_name, output_format):
+    import pyarrow as pa
+
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(file_name)
+    with pa.memory_map(file_name) as source:
+        return pa.ipc.open_file(source).schema
+
+
+def _get_arrow_batches(file_name, output_format):
+    # Record batches of a parquet / arrow file, one at a time
+    import pyarrow as pa
+
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        yield from pq.ParquetFile(file_name).iter_batches()
+        return
+    with pa.memory_map(file_name) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def _get_part_file_name(file_name, part):
+    # part-0.parquet, part-0_1.parquet, part-0_2.parquet ... the file name of the writer sorts before its other parts
+    if not part:
+        return file_name
+    root, extension = os.path.splitext(file_name)
+    return '{}_{}{}'.format(root, part, extension)
+
+
+def _open_arrow_writer(file_name, schema, output_format):
+    import pyarrow as pa
+
+    compression = config.get('ARROW_COMPRESSION', 'zstd')
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        if _compression is not None:
+            return pq.ParquetWriter(file_name, schema, compression=_compression, compression_level=_compression_level)
+        return pq.ParquetWriter(file_name, schema, compression=compression)
+    # Arrow IPC only supports lz4 / zstd buffers, gzip keeps ARROW_COMPRESSION
+    if _compression == 'zstd':
+        compression = pa.Codec('zstd', compression_level=_compression_level)
+    return pa.ipc.new_file(file_name, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+
+
+def _get_partition_dir(market_type, category, output_format):
+    # Hive style Market=/CategoryName= partitions, so the market directory is one dataset for pyarrow / spark
+    partition_dir = (config['DOWNLOAD_LOCATION'] + market_type + '/' + output_format +
+                     '/Market=' + quote(market_type, safe='') + '/CategoryName=' + quote(category, safe=''))
+    _create_directory(partition_dir)
+    return partition_dir
+
+
+def _get_partition_file_name(market_type, category, output_format):
+    partition_dir = _get_partition_dir(market_type, category, output_format)
+    for file_name in os.listdir(partition_dir):
+        os.remove(partition_dir + '/' + file_name)
+    return partition_dir + '/part-0.' + output_format
+
+
+def _concatenate_csv_files(file_name, category_file_names, line_terminator='\r\n'):
+    # TSV with the union of the category headers, streamed row by row
+    header = []
+    for category_file_name in category_file_names:
+        with _open_input(category_file_name, newline='') as category_file:
+            for column in next(csv.reader(category_file, delimiter='\t'), []):
+                if column not in header:
+                    header.append(column)
+    with _open_output(file_name, newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=header, delimiter='\t', lineterminator=line_terminator)
+        writer.writeheader()
+        for category_file_name in category_file_names:
+            with _open_input(category_file_name, newline='') as category_file:
+                writer.writerows(csv.DictReader(category_file, delimiter='\t'))
+
+
+def _get_output_file_name(file_name):
+    return file_name + COMPRESSION_EXTENSIONS.get(_compression, '')
+
+
+def _open_output(file_name, newline=None):
+    # Text file for writing, compressed as it is written when set_compression is on
+    if _compression is None:
+        return open(file_name, 'w', newline=newline, encoding='utf-8')
+    return io.TextIOWrapper(io.BufferedWriter(_CompressedFile(file_name), 1024 * 1024), encoding='utf-8',
+                            newline=newline)
+
+
+def _open_input(file_name, newline=None):
+    # Text file for reading, decompressed by the extension it was written with
+    if file_name.endswith(COMPRESSION_EXTENSIONS['gzip']):
+        return gzip.open(file_name, 'rt', encoding='utf-8', newline=newline)
+    if file_name.endswith(COMPRESSION_EXTENSIONS['zstd']):
+        if _has_zstandard():
+            import zstandard
+            return zstandard.open(file_name, 'rt', encoding='utf-8', newline=newline)
+        import pyarrow as pa
+        return io.TextIOWrapper(pa.CompressedInputStream(file_name, 'zstd'), encoding='utf-8', newline=newline)
+    return open(file_name, 'r', newline=newline, encoding='utf-8')
+
+
+def _has_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+
+def _record_write(output_format, file_name, seconds):
+    record_write(output_format, file_name, seconds, _uncompressed_sizes.pop(file_name, None))
+
+
+class _CompressedFile(io.RawIOBase):
+    # Binary file that compresses everything written to it on the fly and counts the bytes before compression
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.__size = 0
+        self.__level = _compression_level
+        if _compression == 'gzip':
+            self.__file = gzip.open(file_name, 'wb', compresslevel=_compression_level)
+        elif _has_zstandard():
+            import zstandard
+            self.__file = zstandard.open(file_name, 'wb', cctx=zstandard.ZstdCompressor(level=_compression_level))
+        else:
+            import pyarrow as pa
+            self.__file = pa.CompressedOutputStream(file_name, 'zstd')
+            self.__level = 'default'
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.__file.write(b)
+        size = memoryview(b).nbytes
+        self.__size += size
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        self.__file.close()
+        super().close()
+        compressed_size = os.path.getsize(self.file_name)
+        _uncompressed_sizes[self.file_name] = self.__size
+        logger.info("Compressed {} with {} level {}, {} bytes into {} bytes ({:.1%})"
+                    .format(self.file_name, _compression, self.__level, self.__size, compressed_size,
+                            compressed_size / self.__size if self.__size else 1.0))
+
+
+def _flatten_item(row, item, prefix=''):
+    # Same column naming as json_normalize, nested keys joined with '.'
+    for key, value in item.items():
+        if isinstance(value, dict):
+            _flatten_item(row, value, prefix + key + '.')
+        else:
+            row[prefix + key] = value
+    return row
+
+
+def _get_base_file_name(market_type, category):
+    file_dir = config['DOWNLOAD_LOCATION'] + market_type
+    _create_directory(file_dir)
+    return file_dir + '/' + re.sub('[^a-zA-Z0-9]+', ' ', category)
+
+
 def _create_directory(dir_name):
     if not os.path.exists(dir_name):
         logger.info('Creating Directory: {}'.format(dir_name))
-        os.makedirs(dir_name)
+        os.makedirs(dir_name, exist_ok=True)
 
 
 def _get_data_frame(data):
+    # pandas is only imported by the writes that need a data frame, json output and page workers never load it
+    from pandas import json_normalize
+
     df = json_normalize(data, meta=['Market', ['Category', 'Name'], ['Category', 'SubCategory', 'Name'],
                                     ['Category', 'SubCategory', 'Products', 'Name']],
                         record_path=['Category', 'SubCategory', 'Products', 'Items'])
@@ -60,7 +722,7 @@ def _get_data_frame(data):
 def _write_json_data(file_name, data):
     start_time = datetime.now()
     logger.info("Writing json file  {}, started at {}".format(file_name, start_time))
-    with open(file_name, 'w') as file:
+    with _open_output(file_name) as file:
         json.dump(data, file)
 
     completed_time = datetime.now()
@@ -72,13 +734,30 @@ def _write_csv_data(file_name, data):
     start_time = datetime.now()
     logger.info("Writing csv file  {}, started at {}".format(file_name, start_time))
     df = _get_data_frame(data)
-    df.to_csv(file_name, index=None, header=True, sep='\t', encoding='utf-8')
+    with _open_output(file_name, newline='') as file:
+        df.to_csv(file, index=None, header=True, sep='\t')
     completed_time = datetime.now()
     logger.info("Successfully writes csv file  {}, completed at {}, total time - {}".format(file_name, completed_time,
                                                                                             completed_time - start_time))
 
 
+def _write_arrow_data(file_name, data, output_format):
+    start_time = datetime.now()
+    logger.info("Writing {} file  {}, started at {}".format(output_format, file_name, start_time))
+    df = _get_data_frame(data)
+    df = df.astype(object).where(df.notna(), None)
+    writer = _ArrowStreamWriter(file_name, output_format)
+    writer.write_items({}, df.to_dict('records'))
+    writer.close()
+    completed_time = datetime.now()
+    logger.info("Successfully writes {} file  {}, completed at {}, total time - {}".format(output_format, file_name,
+                                                                                          completed_time,
+                                                                                          completed_time - start_time))
+
+
 def _write_excel_data(file_name, sheet_name, data):
+    from pandas import ExcelWriter
+
     start_time = datetime.now()
     logger.info("Writing excel file  {}, started at {}".format(file_name, start_time))
     df = _get_data_frame(data)
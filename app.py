@@ -1,142 +1,627 @@
 import argparse
+import json
+import sys
 from datetime import datetime
 from functools import partial
-from math import ceil
-from multiprocessing import Pool
 from multiprocessing import cpu_count
-from threading import Thread
-
-from tqdm import tqdm
+from time import sleep
 
 import scripts.logger_util as Logger
-from scripts.FileWriterUtil import write_to_file
+from scripts.checkpoint import CheckpointStore
+from scripts.crawl_index import CrawlIndex
+from scripts.distributed import get_work_queue, is_drained, run_workers
+from scripts.FileWriterUtil import COMPRESSIONS, PARTITIONED_FORMATS, concatenate_stream_files, \
+    is_compression_available, open_stream_writer, remove_partitions, set_compression, write_consolidated_file, \
+    write_delta_file, write_to_file
+from scripts.metrics import ITEMS, PAGES, enable_profiling, merge_profiles, stage, start_metrics_server, \
+    write_summary
 from scripts.request_util import get_data_from_url
-from scripts.session_helper import start_auth_updater, stop_auth_updater
+from scripts.response_cache import enable_response_cache, is_offline
+from scripts.session_helper import AuthError, SessionPool, start_auth_updater, stop_auth_updater
 from scripts.utils import *
+from scripts.work_scheduler import WorkScheduler
+from scripts.writer_pool import WriterPool
 
 config = get_configuration()
 logger = Logger.get_logger(__name__)
 
 FLAG = None
 
+# camelCase listing key -> PascalCase column, listings repeat the same few keys so each is converted once per process
+_pascal_keys = {}
+
 
 def _convert_to_pascal(string):
-    return "%s%s" % (string[0].upper(), string[1:])
+    pascal = _pascal_keys.get(string)
+    if pascal is None:
+        pascal = _pascal_keys[string] = string[:1].upper() + string[1:]
+    return pascal
 
 
-def get_product_items(target_url, start_value):
+def _get_listing_items(product_items):
     items = []
-    product_items = get_data_from_url(url=get_api_url(target_url, start_value), headers=get_referer_headers(target_url))
-    if product_items:
-        if 'listings' in product_items and isinstance(product_items['listings'], list):
-            for product_item in product_items['listings']:
-                item = dict((_convert_to_pascal(k), v) for k, v in product_item.items())
-                items.append(item)
-        return items
-    return None
+    if 'listings' in product_items and isinstance(product_items['listings'], list):
+        for product_item in product_items['listings']:
+            items.append({_convert_to_pascal(k): v for k, v in product_item.items()})
+    return items
 
 
-def get_items_details(target_url):
-    product_url = get_api_url(target_url, 0)
-    product_items = get_data_from_url(url=product_url, headers=get_referer_headers(target_url))
-    response = []
-    if product_items:
+def _get_page_items(product_items):
+    items = _get_listing_items(product_items)
+    if config.get('IMAGE_HASH'):
+        from scripts.image_pipeline import add_image_hashes
+        with stage('image_hash'):
+            add_image_hashes(items)
+    PAGES.inc()
+    ITEMS.inc(amount=len(items))
+    return items
+
+
+def _check_page_length(target_url, start_value, product_items):
+    # A page short of the page size that is not the last one means the endpoint caps pages below it, the listings past
+    # the cap of every page are never asked for
+    page_size = get_page_size()
+    listings = product_items.get('listings') or []
+    if len(listings) < page_size and start_value + page_size < product_items['numFound']:
+        logger.error("Page at {} of '{}' has {} listings for a page size of {}, the listing endpoint caps pages below "
+                     "the page size and listings are missed, use a smaller --page-size or 'auto'"
+                     .format(start_value, target_url, len(listings), page_size))
+
+
+def get_product_items(target_url, start_value):
+    with stage('page'):
+        product_items = get_data_from_url(url=get_api_url(target_url, start_value),
+                                          headers=get_referer_headers(target_url))
+        if product_items:
+            _check_page_length(target_url, start_value, product_items)
+            return _get_page_items(product_items)
+        return None
+
+
+def get_product_page(target_url, start_value):
+    with stage('page'):
+        product_items = get_data_from_url(url=get_api_url(target_url, start_value),
+                                          headers=get_referer_headers(target_url))
+        if product_items:
+            _check_page_length(target_url, start_value, product_items)
+            return product_items['numFound'], _get_page_items(product_items)
+        return None
+
+
+def _get_unchanged_items(target_url, on_page, index):
+    logger.info("'{}' is unchanged since the last crawl, reusing indexed items".format(target_url))
+    items = index.get_items(target_url)
+    if on_page is not None:
+        on_page(target_url, items)
+        return []
+    return items
+
+
+def get_items_details(target_url, on_page=None, checkpoint=None, index=None):
+    items_found = checkpoint.get_items_found(target_url) if checkpoint is not None else None
+    if items_found is None:
+        product_url = get_api_url(target_url, 0)
+        product_items = get_data_from_url(url=product_url, headers=get_referer_headers(target_url))
+        if not product_items:
+            return None
         logger.info("Getting data from '{}'".format(product_url))
+        _check_page_length(target_url, 0, product_items)
         items_found = product_items['numFound']
-        logger.debug('Items Found - {}'.format(items_found))
-        with Pool(processes=config['NUM_OF_WORKER_PROCESS']) as pool:
-            results = list(tqdm(pool.imap(partial(get_product_items, target_url), range(0, items_found, 12)),
-                                total=ceil(items_found / 12)))
-            for result in results:
-                if result is not None:
-                    response += result
-        logger.debug('Item Processed - {}'.format(len(response)))
-        return response
-    return None
+        stored_pages = {0: _get_page_items(product_items)}
+        if checkpoint is not None:
+            checkpoint.add_page(target_url, 0, stored_pages[0])
+            checkpoint.set_items_found(target_url, items_found)
+    else:
+        stored_pages = checkpoint.get_pages(target_url)
+        logger.info("Resuming '{}' with {} pages from checkpoint".format(target_url, len(stored_pages)))
+    logger.debug('Items Found - {}'.format(items_found))
+
+    if index is not None:
+        fingerprint = index.get_fingerprint(stored_pages.get(0, []))
+        if index.is_unchanged(target_url, items_found, fingerprint):
+            return _get_unchanged_items(target_url, on_page, index)
+        index.begin(target_url)
+
+    pages = {}
+
+    def add_page(start_value, items):
+        if index is not None:
+            index.add_items(target_url, items)
+        if on_page is not None:
+            on_page(target_url, items)
+        else:
+            pages[start_value] = items
+
+    page_starts = get_page_starts(items_found)
+    for start_value in page_starts:
+        if start_value in stored_pages:
+            add_page(start_value, stored_pages[start_value])
+
+    complete = True
+    remaining_page_starts = [start_value for start_value in page_starts if start_value not in stored_pages]
+    if remaining_page_starts:
+        from tqdm import tqdm
+        # Closed rather than terminated, a worker killed while it flushes its log records would hold the log queue
+        pool = get_process_pool(config['NUM_OF_WORKER_PROCESS'])
+        try:
+            results = pool.imap(partial(get_product_items, target_url), remaining_page_starts)
+            for start_value, result in tqdm(zip(remaining_page_starts, results), total=len(remaining_page_starts)):
+                if result is None:
+                    complete = False
+                    continue
+                if checkpoint is not None:
+                    checkpoint.add_page(target_url, start_value, result)
+                add_page(start_value, result)
+        finally:
+            pool.close()
+            pool.join()
+    if index is not None:
+        index.finish(target_url, items_found, fingerprint, complete)
+
+    response = []
+    for start_value in sorted(pages):
+        response += pages[start_value]
+    logger.debug('Item Processed - {}'.format(len(response)))
+    if not is_offline():
+        logger.debug('Connections so far - {} new, {} reused'.format(*SessionPool().get_connection_counts()))
+    return response
+
+
+def _get_category_products(category):
+    """
+    Returns (sub category title, product title, target url) for every product of the category.
+    """
+    products = []
+    for sub_category in category['l3Units']:
+        products.append((sub_category['title'], sub_category['title'], sub_category['targetUrl']))
+        if 'l4Units' in sub_category and isinstance(sub_category['l4Units'], list):
+            for sub_category_products in sub_category['l4Units']:
+                products.append((sub_category['title'], sub_category_products['title'],
+                                 sub_category_products['targetUrl']))
+    return products
+
+
+def _get_category_items_details(market_type, category, crawler, on_page=None, checkpoint=None, index=None):
+    if isinstance(crawler, WorkScheduler):
+        return crawler.get_category_items_details((market_type, category['title']), on_page)
+    target_urls = [target_url for _, _, target_url in _get_category_products(category)]
+    if crawler is None:
+        return dict((target_url, get_items_details(target_url, on_page, checkpoint, index))
+                    for target_url in target_urls)
+
+    category_items_details = {}
+    if checkpoint is not None:
+        for target_url in target_urls:
+            items_found = checkpoint.get_items_found(target_url)
+            if items_found is not None and len(checkpoint.get_pages(target_url)) == len(get_page_starts(items_found)):
+                # Every page is in the checkpoint, re-emit it through the pool engine path without any request
+                category_items_details[target_url] = get_items_details(target_url, on_page, checkpoint, index)
+
+    unchanged_target_urls = set()
+
+    def is_unchanged(target_url, first_page):
+        if index is None or not index.is_unchanged(target_url, first_page['numFound'],
+                                                   index.get_fingerprint(_get_listing_items(first_page))):
+            return False
+        unchanged_target_urls.add(target_url)
+        return True
+
+    logger.info("Getting data of '{}' category using async engine".format(category['title']))
+    target_urls = [target_url for target_url in target_urls if target_url not in category_items_details]
+    for target_url, pages in crawler.get_pages(target_urls, is_unchanged).items():
+        if pages is None:
+            category_items_details[target_url] = None
+            continue
+        if target_url in unchanged_target_urls:
+            category_items_details[target_url] = _get_unchanged_items(target_url, on_page, index)
+            continue
+        items_found = pages[0]['numFound']
+        if checkpoint is not None:
+            checkpoint.set_items_found(target_url, items_found)
+        if index is not None:
+            index.begin(target_url)
+        response = []
+        for start_value, page in zip(get_page_starts(items_found) or [0], pages):
+            if not page:
+                continue
+            _check_page_length(target_url, start_value, page)
+            items = _get_page_items(page)
+            if checkpoint is not None:
+                checkpoint.add_page(target_url, start_value, items)
+            if index is not None:
+                index.add_items(target_url, items)
+            if on_page is not None:
+                on_page(target_url, items)
+            else:
+                response += items
+        if index is not None:
+            index.finish(target_url, items_found, index.get_fingerprint(_get_listing_items(pages[0])),
+                         all(pages))
+        logger.debug('Item Processed - {} for {}'.format(len(response), target_url))
+        category_items_details[target_url] = response
+    return category_items_details
+
+
+def _write_category_delta(market_type, category, index):
+    delta = {'Market': market_type, 'CategoryName': category['title'], 'Added': [], 'Changed': [], 'Removed': []}
+    for sub_category_title, product_title, target_url in _get_category_products(category):
+        product_delta = index.pop_delta(target_url)
+        if product_delta is None:
+            continue
+        meta = {'SubCategoryName': sub_category_title, 'ProductName': product_title}
+        for key in ('Added', 'Changed', 'Removed'):
+            delta[key] += [dict(meta, **item) for item in product_delta[key]]
+    write_delta_file(market_type, category['title'], delta)
+
+
+def _get_stream_page_writer(market_type, category, stream_writer):
+    products = dict((target_url, (sub_category_title, product_title))
+                    for sub_category_title, product_title, target_url in reversed(_get_category_products(category)))
+
+    def on_page(target_url, items):
+        sub_category_title, product_title = products[target_url]
+        stream_writer.write_items({'Market': market_type, 'CategoryName': category['title'],
+                                   'SubCategoryName': sub_category_title, 'ProductName': product_title}, items)
+
+    return on_page
+
+
+def _get_checkpoint_output():
+    return FLAG.output + '-stream' if FLAG.stream else FLAG.output
+
+
+def _is_category_done(market_type, category, checkpoint):
+    return checkpoint is not None and checkpoint.is_category_done(market_type, category, _get_checkpoint_output())
+
+
+def _get_selected_categories(market):
+    categories = []
+    for category in market['l2Units']:
+        if FLAG.include_categories is not None and category['title'] not in FLAG.include_categories:
+            logger.info(
+                "'{}' category is not in categories inclusion list  '{}', Hence ignoring this category"
+                    .format(category['title'], ', '.join(FLAG.include_categories)))
+            continue
+        if FLAG.exclude_categories is not None and category['title'] in FLAG.exclude_categories:
+            logger.info(
+                "'{}' category is in categories exclusion list  '{}', Hence ignoring this category"
+                    .format(category['title'], ', '.join(FLAG.exclude_categories)))
+            continue
+        categories.append(category)
+    return categories
+
 
+def _write_category(market_type, category, data, output_format):
+    # Runs in a writer process
+    with stage('write'):
+        write_to_file(market_type, category, data, output_format)
 
-def get_udaan_data(market_type):
-    data = []
-    market_categories = get_data_from_url(url=get_api_url("/market/v1", 0), headers=get_referer_headers("/market/v1"))
-    if market_categories:
-        file_write_thread = []
-        for market in market_categories['listingUnits']:
-            if market['title'] == market_type:
-                logger.info("Getting data of '{}'".format(market['title']))
-                market_data = {'Market': market['title'], 'Category': []}
-                for category in market['l2Units']:
-                    if FLAG.include_categories is not None and category['title'] not in FLAG.include_categories:
-                        logger.info(
-                            "'{}' category is not in categories inclusion list  '{}', Hence ignoring this category"
-                                .format(category['title'], ', '.join(FLAG.include_categories)))
-                        continue
-                    if FLAG.exclude_categories is not None and category['title'] in FLAG.exclude_categories:
-                        logger.info(
-                            "'{}' category is in categories exclusion list  '{}', Hence ignoring this category"
-                                .format(category['title'], ', '.join(FLAG.exclude_categories)))
-                        continue
-                    logger.info("Getting data of '{}' category under {} market type"
-                                .format(category['title'], market['title']))
-                    category_data = {'Name': category['title'], 'SubCategory': []}
-                    for sub_category in category['l3Units']:
-                        sub_category_data = {'Name': sub_category['title'], 'Products': []}
-                        logger.info("Getting info of ({} -> {} -> {}) product"
-                                    .format(category['title'], sub_category['title'], sub_category['title']))
-                        item_details = get_items_details(sub_category['targetUrl'])
-                        if item_details is not None:
-                            sub_category_data['Products'].append({'Name': sub_category['title'],
-                                                                  'Items': item_details})
-                        if 'l4Units' in sub_category and isinstance(sub_category['l4Units'], list):
-                            for sub_category_products in sub_category['l4Units']:
-                                logger.info("Getting info of ({} -> {} -> {}) product"
-                                            .format(category['title'], sub_category['title'],
-                                                    sub_category_products['title'], ))
-                                sub_item_details = get_items_details(sub_category_products['targetUrl'])
-                                if sub_item_details is not None:
-                                    sub_category_data['Products'].append({'Name': sub_category_products['title'],
-                                                                          'Items': sub_item_details})
-
-                        category_data['SubCategory'].append(sub_category_data)
-
-                    market_data['Category'].append(category_data)
-                    temp_data = {"Market": market_type, "Category": []}
-                    temp_data['Category'].append(category_data)
-                    thread = Thread(target=write_to_file,
-                                    name=(str(market_data['Market']) + "-" + str(category_data['Name'])),
-                                    args=(market_data['Market'], category_data['Name'], temp_data, FLAG.output))
-                    thread.start()
-                    file_write_thread.append(thread)
-                data.append(market_data)
-                for thread in file_write_thread:
-                    if thread.is_alive():
-                        logger.debug("Waiting for file write operation to complete, file name - " + thread.getName())
-                        thread.join()
-        return data
+
+def _write_consolidated(market_type, categories, output_format):
+    # Runs in a writer process
+    with stage('write'):
+        write_consolidated_file(market_type, categories, output_format)
+
+
+def _get_category_done_callback(market_type, category_entry, checkpoint):
+    # Runs once the category file is written, only written categories go into the consolidated file
+    def on_done(_):
+        category_entry['Written'] = True
+        if checkpoint is not None:
+            checkpoint.set_category_done(market_type, category_entry['Name'], _get_checkpoint_output())
+
+    return on_done
+
+
+def _add_consolidated_market(consolidated_markets, market_type, _):
+    consolidated_markets.add(market_type)
+
+
+def _get_market_tree():
+    with stage('market_tree'):
+        return get_data_from_url(url=get_api_url("/market/v1", 0), headers=get_referer_headers("/market/v1"))
+
+
+def _get_selected_markets(market_categories, market_types):
+    """
+    Markets of the tree named in market_types, every market for 'all', in the order of the tree.
+    """
+    markets = [market for market in market_categories['listingUnits']
+               if 'all' in market_types or market['title'] in market_types]
+    titles = set(market['title'] for market in markets)
+    for market_type in market_types:
+        if market_type != 'all' and market_type not in titles:
+            logger.info('No data found for given market {}.'.format(market_type))
+    return markets
+
+
+def _get_target_urls(markets):
+    return [target_url for _, categories in markets for category in categories
+            for _, _, target_url in _get_category_products(category)]
+
+
+def _probe_page_size(markets):
+    """
+    Largest page size the listing endpoint honours, up to PAGE_SIZE_MAX. The first page of a few target urls is asked
+    for with PAGE_SIZE_MAX listings. A page shorter than both shows the cap of the endpoint, which is confirmed by
+    asking for the next page at that size. A target url that fits in one page shows its listings are honoured in one
+    page, without a confirmed cap the largest such page is used, or the default page size when it is smaller.
+    """
+    max_page_size = int(config.get('PAGE_SIZE_MAX', 100))
+    honoured_page_size = DEFAULT_PAGE_SIZE
+    for target_url in _get_target_urls(markets)[:int(config.get('PAGE_SIZE_PROBES', 3))]:
+        first_page = get_data_from_url(url=get_api_url(target_url, 0, max_page_size),
+                                       headers=get_referer_headers(target_url))
+        if not first_page:
+            continue
+        listings = first_page.get('listings') or []
+        if len(listings) >= max_page_size:
+            logger.info('Listing endpoint honours the page size of {}'.format(max_page_size))
+            return max_page_size
+        if len(listings) == first_page['numFound']:
+            # Too few listings to show a cap, the next target url may have more
+            honoured_page_size = max(honoured_page_size, len(listings))
+            continue
+        page_size = len(listings)
+        if page_size:
+            next_page = get_data_from_url(url=get_api_url(target_url, page_size, page_size),
+                                          headers=get_referer_headers(target_url))
+            next_listings = (next_page or {}).get('listings') or []
+            if len(next_listings) == min(page_size, first_page['numFound'] - page_size) and \
+                    next_listings[:1] != listings[:1]:
+                logger.info('Listing endpoint caps pages at {} listings, using it as page size'.format(page_size))
+                return page_size
+        break
+    if honoured_page_size > DEFAULT_PAGE_SIZE:
+        logger.info('Listing endpoint honours at least {} listings per page, using it as page size'
+                    .format(honoured_page_size))
+        return honoured_page_size
+    logger.warning('Could not confirm a larger page size, using the default page size of {}'.format(DEFAULT_PAGE_SIZE))
+    return DEFAULT_PAGE_SIZE
+
+
+def _check_page_size(markets):
+    """
+    The fixed page size when the listing endpoint honours it, else the shorter length of the first page it returns. The
+    first page of a few target urls is asked for until one has more listings than the page size.
+    """
+    page_size = get_page_size()
+    for target_url in _get_target_urls(markets)[:int(config.get('PAGE_SIZE_PROBES', 3))]:
+        first_page = get_data_from_url(url=get_api_url(target_url, 0), headers=get_referer_headers(target_url))
+        if not first_page:
+            continue
+        listings = first_page.get('listings') or []
+        if len(listings) < min(page_size, first_page['numFound']):
+            logger.error('Listing endpoint returned {} listings for a page size of {}, falling back to a page size '
+                         'of {}'.format(len(listings), page_size, len(listings) or DEFAULT_PAGE_SIZE))
+            return len(listings) or DEFAULT_PAGE_SIZE
+        if first_page['numFound'] > page_size:
+            break
+    return page_size
+
+
+def _get_crawler():
+    if FLAG.engine == 'async':
+        from scripts.async_engine import AsyncCrawler
+        return AsyncCrawler(FLAG.concurrency)
+    elif FLAG.engine == 'global':
+        return WorkScheduler(get_product_page, config['NUM_OF_WORKER_PROCESS'])
     return None
 
 
-def start(market):
-    logger.info("Download started for '{}' data at {} time".format(market, datetime.now()))
-    crawl_json_data = get_udaan_data(market)
-    if crawl_json_data is not None and len(crawl_json_data) > 0:
-        logger.info("Download of '{}' data completed at {} time".format(market, datetime.now()))
-        write_to_file(market, market, crawl_json_data, FLAG.output)
-        logger.info(
-            "Successfully writes consolidated '{}' data, writes completed at {} time".format(market, datetime.now()))
-    else:
-        logger.info('No data found for given market {}.'.format(market))
+def _submit_categories(scheduler, market_type, categories, checkpoint=None, index=None):
+    for category in categories:
+        if not _is_category_done(market_type, category['title'], checkpoint):
+            scheduler.submit((market_type, category['title']),
+                             [target_url for _, _, target_url in _get_category_products(category)], checkpoint, index)
+
+
+def get_udaan_data(market_type, categories, crawler=None, checkpoint=None, index=None, writer=None):
+    """
+    Crawl the categories of the market and write every category file, with the writer pool when given. Returns the
+    market with the names of its categories, the items are only in the category files.
+    """
+    logger.info("Getting data of '{}'".format(market_type))
+    market_data = {'Market': market_type, 'Category': []}
+    for category in categories:
+        logger.info("Getting data of '{}' category under {} market type".format(category['title'], market_type))
+        category_data = {'Name': category['title'], 'SubCategory': []}
+        category_entry = {'Name': category['title'], 'SubCategory': [], 'Written': False}
+        market_data['Category'].append(category_entry)
+        if _is_category_done(market_type, category['title'], checkpoint):
+            logger.info("'{}' category is already written as per checkpoint".format(category['title']))
+            category_entry['Written'] = True
+            continue
+        if FLAG.stream:
+            stream_writer = open_stream_writer(market_type, category['title'], FLAG.output)
+            with stage('category'):
+                _get_category_items_details(market_type, category, crawler,
+                                            _get_stream_page_writer(market_type, category, stream_writer),
+                                            checkpoint, index)
+            stream_writer.close()
+            if index is not None:
+                _write_category_delta(market_type, category, index)
+            logger.info("Streamed '{}' category into {}".format(category['title'], stream_writer.file_name))
+            category_entry['Written'] = True
+            if checkpoint is not None:
+                checkpoint.set_category_done(market_type, category['title'], _get_checkpoint_output())
+            continue
+        with stage('category'):
+            category_items_details = _get_category_items_details(market_type, category, crawler,
+                                                                 checkpoint=checkpoint, index=index)
+        for sub_category in category['l3Units']:
+            sub_category_data = {'Name': sub_category['title'], 'Products': []}
+            logger.info("Getting info of ({} -> {} -> {}) product"
+                        .format(category['title'], sub_category['title'], sub_category['title']))
+            item_details = category_items_details[sub_category['targetUrl']]
+            if item_details is not None:
+                sub_category_data['Products'].append({'Name': sub_category['title'], 'Items': item_details})
+            if 'l4Units' in sub_category and isinstance(sub_category['l4Units'], list):
+                for sub_category_products in sub_category['l4Units']:
+                    logger.info("Getting info of ({} -> {} -> {}) product"
+                                .format(category['title'], sub_category['title'], sub_category_products['title'], ))
+                    sub_item_details = category_items_details[sub_category_products['targetUrl']]
+                    if sub_item_details is not None:
+                        sub_category_data['Products'].append({'Name': sub_category_products['title'],
+                                                              'Items': sub_item_details})
+
+            category_data['SubCategory'].append(sub_category_data)
+
+        if index is not None:
+            _write_category_delta(market_type, category, index)
+        temp_data = {"Market": market_type, "Category": [category_data]}
+        on_done = _get_category_done_callback(market_type, category_entry, checkpoint)
+        if writer is not None:
+            writer.submit(_write_category, (market_type, category['title'], temp_data, FLAG.output), on_done)
+        else:
+            _write_category(market_type, category['title'], temp_data, FLAG.output)
+            on_done(None)
+    return market_data
+
+
+def start(market_types):
+    """
+    Crawl every market of market_types, or of the whole tree for 'all', in one run. The markets share the tree fetch,
+    the crawler and the writer pool, with the global engine their pages are fed through one queue so the pool moves on
+    to the next market while the last pages of one are still in flight.
+    """
+    logger.info("Download started for '{}' data at {} time".format("', '".join(market_types), datetime.now()))
+    market_categories = _get_market_tree()
+    if not market_categories:
+        logger.info('No data found for given market {}.'.format(', '.join(market_types)))
+        return
+    markets = [(market['title'], _get_selected_categories(market))
+               for market in _get_selected_markets(market_categories, market_types)]
+    if config.get('PAGE_SIZE') == 'auto':
+        # Resolved before the checkpoints are opened and the pools start, every process crawls with the same size
+        config.update({'PAGE_SIZE': _probe_page_size(markets)})
+    elif get_page_size() != DEFAULT_PAGE_SIZE:
+        config.update({'PAGE_SIZE': _check_page_size(markets)})
+    checkpoints = dict((market_type, CheckpointStore(market_type, FLAG.resume)) for market_type, _ in markets)
+    indexes = dict((market_type, CrawlIndex(market_type) if FLAG.incremental else None) for market_type, _ in markets)
+    writer = WriterPool() if not FLAG.stream else None
+    crawler = _get_crawler()
+    if isinstance(crawler, WorkScheduler):
+        # Queue every market up front, the categories are then collected market by market in order below
+        for market_type, categories in markets:
+            _submit_categories(crawler, market_type, categories, checkpoints[market_type], indexes[market_type])
+    try:
+        crawled_markets = [get_udaan_data(market_type, categories, crawler, checkpoints[market_type],
+                                          indexes[market_type], writer)
+                           for market_type, categories in markets]
+    except AuthError:
+        # The workers finish their last tasks, which fail at once without a token, and exit instead of being killed
+        if writer is not None:
+            writer.close()
+        raise
+    finally:
+        if crawler is not None:
+            crawler.close()
+    if writer is not None:
+        # Every category write has finished or failed, their on_done callbacks have run
+        writer.join()
+
+    consolidated_markets = set()
+    for market_data in crawled_markets:
+        market_type = market_data['Market']
+        # Only categories written in this run, or in an earlier one as per checkpoint, a stale file of a category
+        # that failed now must not end up in the market file
+        category_names = [category['Name'] for category in market_data['Category'] if category['Written']]
+        failed_categories = [category['Name'] for category in market_data['Category'] if not category['Written']]
+        logger.info("Download of '{}' data completed at {} time".format(market_type, datetime.now()))
+        if failed_categories:
+            logger.error("Categories '{}' of '{}' could not be written, see the errors above, the consolidated data "
+                         "leaves them out".format("', '".join(failed_categories), market_type))
+        if FLAG.output in PARTITIONED_FORMATS:
+            logger.info("'{}' data is already consolidated as a {} dataset partitioned by Market/CategoryName"
+                        .format(market_type, FLAG.output))
+            consolidated_markets.add(market_type)
+        elif FLAG.stream:
+            with stage('write'):
+                concatenate_stream_files(market_type, category_names, FLAG.output)
+            consolidated_markets.add(market_type)
+        else:
+            writer.submit(_write_consolidated, (market_type, category_names, FLAG.output),
+                          partial(_add_consolidated_market, consolidated_markets, market_type))
+    if writer is not None:
+        writer.close()
+    for market_data in crawled_markets:
+        if market_data['Market'] in consolidated_markets:
+            logger.info("Successfully writes consolidated '{}' data, writes completed at {} time"
+                        .format(market_data['Market'], datetime.now()))
+        else:
+            logger.error("Consolidated '{}' data could not be written, see the errors above"
+                         .format(market_data['Market']))
+    for market_type, _ in markets:
+        checkpoints[market_type].close()
+        if indexes[market_type] is not None:
+            indexes[market_type].close()
+
+
+def start_coordinator(market_types, work_queue):
+    """
+    Publish the first page of every target url of the markets to the work queue, crawl it with the local workers like
+    any other node and wait until every node is done. The workers publish the remaining pages of each target url.
+    """
+    logger.info("Publishing '{}' work items to {} at {} time".format("', '".join(market_types), FLAG.work_queue,
+                                                                      datetime.now()))
+    market_categories = _get_market_tree()
+    if not market_categories:
+        logger.info('No data found for given market {}.'.format(', '.join(market_types)))
+        return
+    markets = _get_selected_markets(market_categories, market_types)
+    items = []
+    for market in markets:
+        if not FLAG.resume:
+            work_queue.clear(market['title'])
+            remove_partitions(market['title'], FLAG.output)
+        for category in _get_selected_categories(market):
+            for sub_category_title, product_title, target_url in _get_category_products(category):
+                items.append({'market': market['title'], 'category': category['title'],
+                              'sub_category': sub_category_title, 'product': product_title,
+                              'target_url': target_url, 'start_value': 0, 'output': FLAG.output})
+    work_queue.put(items)
+    logger.info("Published {} target urls of '{}'".format(len(items), "', '".join(m['title'] for m in markets)))
+
+    run_workers(work_queue, get_product_page, config['NUM_OF_WORKER_PROCESS'])
+    for market in markets:
+        counts = work_queue.get_counts(market['title'])
+        while not is_drained(counts):
+            logger.info('Waiting for other workers, work items of {} - {}'.format(market['title'], counts))
+            sleep(float(config.get('WORK_QUEUE_POLL_INTERVAL', 2)) * 5)
+            counts = work_queue.get_counts(market['title'])
+        logger.info("Distributed crawl of '{}' completed, work items - {}".format(market['title'], counts))
 
 
 def main():
     start_time = datetime.now()
     logger.info('Crawling triggered at {} time'.format(start_time))
 
-    start_auth_updater()
-    start(FLAG.market)
-    stop_auth_updater()
+    if FLAG.metrics_port is not None:
+        start_metrics_server(FLAG.metrics_port)
+    if FLAG.profile:
+        enable_profiling(config['DOWNLOAD_LOCATION'] + '.profile/')
+    if FLAG.compress in COMPRESSIONS:
+        set_compression(FLAG.compress, FLAG.compress_level)
+    if FLAG.cache or FLAG.from_cache:
+        enable_response_cache(offline=FLAG.from_cache)
+    if not is_offline():
+        start_auth_updater()
+    if FLAG.role == 'coordinator':
+        start_coordinator(FLAG.market, get_work_queue(FLAG.work_queue))
+    elif FLAG.role == 'worker':
+        run_workers(get_work_queue(FLAG.work_queue), get_product_page, config['NUM_OF_WORKER_PROCESS'])
+    else:
+        start(FLAG.market)
     end_time = datetime.now()
+    if not is_offline():
+        stop_auth_updater()
+        logger.info('Connections opened - {}, reused - {}'.format(*SessionPool().get_connection_counts()))
+    merge_profiles()
+    write_summary(config['DOWNLOAD_LOCATION'] + 'run-summary.json')
     logger.info('Crawling successfully completed at {} time'.format(end_time))
     logger.info('Total time {}'.format(end_time - start_time))
+    Logger.stop_logging()
 
 
 def str2bool(v):
@@ -148,11 +633,29 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
-if __name__ == "__main__":
+def _parse_page_size(v):
+    if v == 'auto':
+        return v
+    if not v.isdigit() or int(v) < 1:
+        raise argparse.ArgumentTypeError("Positive number or 'auto' expected.")
+    return int(v)
+
+
+def _parse_setting(v):
+    key, separator, value = v.partition('=')
+    if not separator or not key:
+        raise argparse.ArgumentTypeError('KEY=VALUE expected.')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def get_arg_parser():
     parser = argparse.ArgumentParser(description='Data Crawler')
 
     parser.add_argument('-o', '--output', type=str, help='Output format', default='json',
-                        choices=['json', 'csv', 'excel'])
+                        choices=['json', 'csv', 'excel', 'parquet', 'arrow'])
     parser.add_argument('--folder-loc', type=str, help='Folder location where files will get store',
                         default='data')
     parser.add_argument("--proxy", type=str2bool, nargs='?',
@@ -162,16 +665,109 @@ if __name__ == "__main__":
                         help='Categories to Exclude', required=False, default=None)
     parser.add_argument('-i', '--include-categories', nargs='*', type=str,
                         help='Categories to Include', required=False, default=None)
+    parser.add_argument('--engine', type=str,
+                        help='Crawl engine, process pool per sub category, asyncio or one process pool fed by a '
+                             'global work queue of every page of the market',
+                        default='pool', choices=['pool', 'async', 'global'])
+    parser.add_argument('--concurrency', type=int, help='Max concurrent requests for async engine', default=32)
+    parser.add_argument("--stream", type=str2bool, nargs='?',
+                        const=True, default=False,
+                        help="Write items to disk page by page, json as NDJSON, csv as append only TSV and "
+                             "parquet / arrow as record batches.")
+    parser.add_argument('--compress', type=str,
+                        help='Compress json / csv output while it is written, parquet / arrow use the codec for '
+                             'their pages and record batches (arrow only supports zstd)',
+                        default='none', choices=['gzip', 'zstd', 'none'])
+    parser.add_argument('--compress-level', type=int,
+                        help='Compression level, default 6 for gzip and 3 for zstd', default=None)
+    parser.add_argument("--resume", type=str2bool, nargs='?',
+                        const=True, default=False,
+                        help="Resume the crawl from the checkpoint of a previous run, skipping completed pages.")
+    parser.add_argument("--incremental", type=str2bool, nargs='?',
+                        const=True, default=False,
+                        help="Skip target urls unchanged since the last crawl and write a delta file per category.")
+
+    parser.add_argument("--image-hash", type=str2bool, nargs='?',
+                        const=True, default=False,
+                        help="Download the image of every listing while crawling and add its perceptual hash as the "
+                             "ImageHash column.")
+    parser.add_argument("--cache", type=str2bool, nargs='?',
+                        const=True, default=False,
+                        help="Keep API responses in an on disk cache and revalidate them with conditional requests "
+                             "once their TTL has passed.")
+    parser.add_argument("--from-cache", type=str2bool, nargs='?',
+                        const=True, default=False,
+                        help="Replay a previous crawl from the response cache without any API request.")
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve crawl metrics on http://127.0.0.1:<port>/metrics (Prometheus) and /metrics.json',
+                        default=None)
+    parser.add_argument("--profile", type=str2bool, nargs='?',
+                        const=True, default=False,
+                        help="Profile every crawl stage with cProfile into <folder-loc>/.profile/<stage>.prof.")
+    parser.add_argument('--page-size', type=_parse_page_size,
+                        help="Listings per page request, or 'auto' to probe the largest page size the API honours. "
+                             "Default PAGE_SIZE setting, else 12", default=None)
+    parser.add_argument('--set', nargs='*', type=_parse_setting, default=[], metavar='KEY=VALUE',
+                        help='Override settings of config/config.json for this run, values are parsed as json when '
+                             'possible. CRAWLER_<KEY> environment variables override the file as well')
+    parser.add_argument('--log-level', type=str.upper, choices=Logger.LOG_LEVELS,
+                        help='Lowest level logged, default LOG_LEVEL setting, else INFO', default=None)
+    parser.add_argument('--log-format', type=str, choices=Logger.LOG_FORMATS,
+                        help='json writes one json object per log record, default LOG_FORMAT setting, else text',
+                        default=None)
+    parser.add_argument('--role', type=str,
+                        help='Distributed crawl role, the coordinator publishes the market to --work-queue and every '
+                             'worker node crawls pages from it into the shared partitioned output directory',
+                        default=None, choices=['coordinator', 'worker'])
+    parser.add_argument('--work-queue', type=str,
+                        help='Work queue of a distributed crawl, sqlite:///path/to/queue.sqlite', default=None)
 
     requiredNamed = parser.add_argument_group('required arguments')
-    requiredNamed.add_argument('--market', type=str, help='Market to crawl', required=True)
+    requiredNamed.add_argument('--market', nargs='+', type=str,
+                               help="Markets to crawl in one run, 'all' for every market, not needed for --role worker")
+
+    return parser
 
+
+if __name__ == "__main__":
+    parser = get_arg_parser()
     FLAG = parser.parse_args()
+    if FLAG.stream and FLAG.output == 'excel':
+        parser.error("--stream does not support excel output")
+    if FLAG.market is None and FLAG.role != 'worker':
+        parser.error("the following arguments are required: --market")
+    if FLAG.role is not None and FLAG.work_queue is None:
+        parser.error("--role needs --work-queue")
+    if FLAG.role == 'coordinator' and FLAG.output == 'excel':
+        parser.error("distributed crawl does not support excel output")
+    if FLAG.compress != 'none' and FLAG.output == 'excel':
+        parser.error("--compress does not support excel output, xlsx files are zip compressed already")
+    if not is_compression_available(FLAG.compress):
+        parser.error("--compress zstd needs the zstandard or pyarrow package")
+    if FLAG.from_cache and FLAG.image_hash:
+        parser.error("--from-cache does not cache listing images, it can not be used with --image-hash")
     print(FLAG)
-    config = get_configuration()
-    config['NUM_OF_WORKER_PROCESS'] = cpu_count() - 1
-    config['PROXY'] = True if FLAG.proxy else False
-    config['DOWNLOAD_LOCATION'] = FLAG.folder_loc if FLAG.folder_loc.endswith("/") else FLAG.folder_loc + "/"
-    update_configuration(config)
+    config.update({
+        'NUM_OF_WORKER_PROCESS': max(1, cpu_count() - 1),
+        'PROXY': True if FLAG.proxy else False,
+        'DOWNLOAD_LOCATION': FLAG.folder_loc if FLAG.folder_loc.endswith("/") else FLAG.folder_loc + "/",
+        'IMAGE_HASH': FLAG.image_hash,
+    })
+    if FLAG.page_size is not None:
+        config.update({'PAGE_SIZE': FLAG.page_size})
+    config.update(dict(FLAG.set))
+    if FLAG.role is not None and config.get('PAGE_SIZE') == 'auto':
+        parser.error("distributed crawl needs a fixed --page-size, the same on every node")
+    log_level = (FLAG.log_level or config.get('LOG_LEVEL', 'INFO')).upper()
+    log_format = FLAG.log_format or config.get('LOG_FORMAT', 'text')
+    if log_level not in Logger.LOG_LEVELS or log_format not in Logger.LOG_FORMATS:
+        parser.error("LOG_LEVEL must be one of {} and LOG_FORMAT one of {}".format(', '.join(Logger.LOG_LEVELS),
+                                                                                   ', '.join(Logger.LOG_FORMATS)))
+    Logger.configure_logging(log_level, log_format, config.get('LOG_REPEAT_LIMIT'), config.get('LOG_REPEAT_WINDOW'))
 
-    main()
+    try:
+        main()
+    except AuthError as e:
+        logger.error('{}, hence terminating the service'.format(e))
+        Logger.stop_logging()
+        sys.exit(1)
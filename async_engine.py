@@ -0,0 +1,169 @@
+import asyncio
+import os
+from time import perf_counter
+
+import aiohttp
+
+import scripts.logger_util as Logger
+from scripts.metrics import record_request
+from scripts.rate_limiter import FAILED, SUCCESS, THROTTLED, get_backoff_delay, get_outcome, get_rate_limiter, \
+    get_retry_after
+from scripts.response_cache import get_response_cache, is_offline
+from scripts.session_helper import AuthError, SessionPool, get_auth, get_auth_version, refresh_auth
+from scripts.utils import *
+
+config = get_configuration()
+logger = Logger.get_logger(__name__)
+
+
+class AsyncCrawler:
+    """
+    Fetch every page of many target urls under one event loop, bounded by a single concurrency limit.
+    """
+
+    def __init__(self, concurrency):
+        self.__loop = asyncio.new_event_loop()
+        self.__concurrency = concurrency
+        self.__semaphore = None
+        self.__client = None
+        self.__headers = None
+        self.__cookies = None
+        self.__auth_version = None
+
+    def get_pages(self, target_urls, is_unchanged=None):
+        """
+        Returns a dict of target url -> list of decoded pages ordered by start_value,
+        or None when the first page of that target url could not be fetched. Raises AuthError when the token is
+        rejected and can not be replaced.
+        When is_unchanged(target_url, first_page) returns True only the first page of that target url is fetched.
+        """
+        return self.__loop.run_until_complete(self.__get_pages(target_urls, is_unchanged))
+
+    def close(self):
+        if self.__client is not None:
+            self.__loop.run_until_complete(self.__client.close())
+            self.__client = None
+        self.__loop.close()
+
+    async def __get_pages(self, target_urls, is_unchanged):
+        if self.__client is None:
+            self.__semaphore = asyncio.Semaphore(self.__concurrency)
+            self.__client = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.__concurrency, ssl=False),
+                                                  timeout=aiohttp.ClientTimeout(total=10),
+                                                  trust_env=bool(config['PROXY']))
+            if not is_offline():
+                self.__load_session_headers()
+
+        unique_target_urls = list(dict.fromkeys(target_urls))
+        tasks = [asyncio.ensure_future(self.__get_target_pages(target_url, is_unchanged))
+                 for target_url in unique_target_urls]
+        try:
+            results = await asyncio.gather(*tasks)
+        except AuthError:
+            # No page can be fetched any more, the requests still in flight are cancelled rather than waited for
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return dict(zip(unique_target_urls, results))
+
+    async def __get_target_pages(self, target_url, is_unchanged):
+        first_page = await self.__get_data_from_url(target_url, 0)
+        if not first_page:
+            return None
+        if is_unchanged is not None and is_unchanged(target_url, first_page):
+            return [first_page]
+        items_found = first_page['numFound']
+        logger.debug("Items Found - {} for '{}'".format(items_found, target_url))
+        pages = await asyncio.gather(*[self.__get_data_from_url(target_url, start_value)
+                                       for start_value in get_page_starts(items_found)[1:]])
+        return [first_page] + list(pages)
+
+    async def __get_data_from_url(self, target_url, start_value):
+        url = get_api_url(target_url, start_value)
+        cache = get_response_cache()
+        cached_response = cache.get(url) if cache is not None else None
+        if cache is not None and cache.is_usable(cached_response):
+            if cached_response is None:
+                logger.error("Url {} is not in the response cache, PID - {}".format(url, os.getpid()))
+                return None
+            return loads_json(cached_response.content)
+        max_retry = config['MAX_RETRY'] if isinstance(config['MAX_RETRY'], str) else int(config['MAX_RETRY'])
+
+        retry = max_retry
+        rate_limiter = get_rate_limiter()
+        while retry:
+            if retry < max_retry:
+                logger.debug("Retrying url {}...Already retired {} times, Max retry {}"
+                             .format(url, max_retry - retry, max_retry))
+            outcome = FAILED
+            retry_after = None
+            status_code = None
+            async with self.__semaphore:
+                wait = rate_limiter.reserve()
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = rate_limiter.reserve()
+                start_time = perf_counter()
+                auth_version = self.__apply_auth()
+                try:
+                    headers = dict(self.__headers)
+                    headers.update(get_referer_headers(target_url))
+                    if cached_response is not None:
+                        headers.update(cached_response.get_conditional_headers())
+                    async with self.__client.get(url, headers=headers, cookies=self.__cookies) as res:
+                        status_code = res.status
+                        outcome = get_outcome(res.status)
+                        retry_after = get_retry_after(res.headers)
+                        if res.status == 304 and cached_response is not None:
+                            outcome = SUCCESS
+                            cache.refresh(url)
+                            return loads_json(cached_response.content)
+                        if res.status == 200:
+                            content = await res.read()
+                            data = loads_json(content)
+                            if cache is not None:
+                                cache.put(url, res.headers, content)
+                            return data
+                        logger.error("Error occurred while getting data from url - {}, PID - {}\nResposne code - {}"
+                                     .format(url, os.getpid(), res.status))
+                        if res.status == 401 and auth_version is not None:
+                            # The refresh blocks on the auth round-trip, it runs off the event loop
+                            await self.__loop.run_in_executor(None, refresh_auth, auth_version)
+                except asyncio.TimeoutError as e:
+                    outcome = THROTTLED
+                    logger.error(("OOPS!! Timeout Error while accessing url - {}, PID - {}." +
+                                  " Technical Details given below.\n").format(url, os.getpid()))
+                    logger.error(str(e))
+                except aiohttp.ClientError as e:
+                    logger.error(("OOPS!! Client Error while accessing url - {}, PID - {}." +
+                                  " Technical Details given below.\n").format(url, os.getpid()))
+                    logger.error(str(e))
+                finally:
+                    record_request(get_endpoint(url), status_code, perf_counter() - start_time, retry < max_retry)
+                    rate_limiter.release(outcome, retry_after)
+
+            retry -= 1
+            if retry:
+                # Backing off with jitter before retrying again
+                await asyncio.sleep(get_backoff_delay(max_retry - retry, retry_after))
+        return None
+
+    def __load_session_headers(self):
+        # Headers and cookies of a pooled session, the token is applied per request by __apply_auth
+        session_obj = SessionPool().acquire()
+        try:
+            self.__headers = dict(session_obj.session.headers)
+            self.__cookies = session_obj.session.cookies.get_dict()
+        finally:
+            SessionPool().release(session_obj)
+
+    def __apply_auth(self):
+        """
+        Pick up the latest token of the auth broker when it changed, returns the version the request is sent with.
+        """
+        if self.__cookies is None:
+            return None
+        if get_auth_version() != self.__auth_version:
+            self.__auth_version, self.__headers['Authorization'] = get_auth()
+        return self.__auth_version
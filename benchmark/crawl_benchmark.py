@@ -0,0 +1,266 @@
+"""
+End to end throughput benchmark of the crawler against the local mock server, no live API involved.
+
+Run it from the directory that contains the scripts package, the same way as the crawler itself:
+
+    python -m scripts.benchmark.crawl_benchmark --formats json csv parquet --latency-ms 50 --items 600
+
+Every output format is crawled in a fresh process, so peak RSS and start up cost are per format. The report has
+pages/sec, p50/p99 request latency as seen by the crawler, peak RSS and the time spent in output writes.
+--save writes the report as json, --compare fails the run when pages/sec fell more than --tolerance below a saved one.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from multiprocessing import Array
+from time import perf_counter
+
+from scripts.benchmark.mock_server import Catalog, MockUdaanServer
+
+# Request latencies are kept as a histogram of 1 ms buckets up to a minute
+LATENCY_BUCKETS = 60000
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser(description='Crawler throughput benchmark')
+    parser.add_argument('--formats', nargs='+', default=['json'],
+                        choices=['json', 'csv', 'excel', 'parquet', 'arrow'])
+    parser.add_argument('--engine', type=str, default='pool', choices=['pool', 'async', 'global'])
+    parser.add_argument('--stream', action='store_true', help='Crawl with --stream')
+    parser.add_argument('--image-hash', action='store_true', help='Crawl with --image-hash')
+    parser.add_argument('--page-size', type=str, default=None, help="Crawl with --page-size, a number or 'auto'")
+    parser.add_argument('--workers', type=int, default=None, help='NUM_OF_WORKER_PROCESS, default cpu_count() - 1')
+    parser.add_argument('--categories', type=int, default=3)
+    parser.add_argument('--sub-categories', type=int, default=4)
+    parser.add_argument('--l4-units', type=int, default=2)
+    parser.add_argument('--items', type=int, default=120, help='Listings per target url')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--max-page-size', type=int, default=100, help='Most listings the mock server returns per page')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--save', type=str, default=None, help='Write the report to this json file')
+    parser.add_argument('--compare', type=str, default=None, help='Baseline report to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--run-one', type=str, default=None, help=argparse.SUPPRESS)
+    return parser
+
+
+def _write_config(server, workers):
+    os.makedirs('config', exist_ok=True)
+    with open('config/config.json', 'w') as f:
+        json.dump({
+            'BASE_URL': server['url'],
+            'API_BASE_URL': server['url'],
+            'AUTH_URL': server['auth_url'],
+            'CSRF_TOKEN': 'benchmark',
+            'MAX_RETRY': 3,
+            'COOKIE_FILE': 'cookies.txt',
+            'NUM_OF_WORKER_PROCESS': workers,
+            'PROXY': False,
+            'DOWNLOAD_LOCATION': 'data/',
+        }, f, indent=2)
+    with open('cookies.txt', 'w') as f:
+        f.write('# Netscape HTTP Cookie File\n')
+
+
+def _install_latency_probe(latencies):
+    # Installed before the crawler forks its pools so every worker process counts into the same shared histogram.
+    # It has no lock on purpose, a worker killed while holding it would hang the run.
+    import requests
+
+    send = requests.Session.send
+
+    def timed_send(self, request, **kwargs):
+        start_time = perf_counter()
+        try:
+            return send(self, request, **kwargs)
+        finally:
+            _record(latencies, perf_counter() - start_time)
+
+    requests.Session.send = timed_send
+
+    try:
+        import aiohttp
+    except ImportError:
+        return
+    _request = aiohttp.ClientSession._request
+
+    async def timed_request(self, *args, **kwargs):
+        start_time = perf_counter()
+        try:
+            return await _request(self, *args, **kwargs)
+        finally:
+            _record(latencies, perf_counter() - start_time)
+
+    aiohttp.ClientSession._request = timed_request
+
+
+def _record(latencies, seconds):
+    latencies[min(LATENCY_BUCKETS - 1, int(seconds * 1000))] += 1
+
+
+def _get_dir_size(dir_name):
+    size = 0
+    for root, _, files in os.walk(dir_name):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+def _percentile(latencies, count, percent):
+    """
+    Upper bound in ms of the histogram bucket holding the given percentile.
+    """
+    rank = max(1, percent / 100.0 * count)
+    seen = 0
+    for bucket, bucket_count in enumerate(latencies):
+        seen += bucket_count
+        if seen >= rank:
+            return bucket + 1
+    return None
+
+
+def _run_one(params):
+    """
+    Crawl one market in this process and print the measurements as one json line.
+    """
+    _write_config(params['server'], params['workers'])
+    latencies = Array('L', LATENCY_BUCKETS, lock=False)
+    _install_latency_probe(latencies)
+
+    import scripts.app as app
+    from scripts.metrics import WRITE_SECONDS
+    from scripts.session_helper import start_auth_updater, stop_auth_updater
+
+    args = ['--market', params['market'], '-o', params['output'], '--engine', params['engine']]
+    if params['stream']:
+        args.append('--stream')
+    if params['image_hash']:
+        args.append('--image-hash')
+    if params['page_size'] is not None:
+        args += ['--page-size', params['page_size']]
+    app.FLAG = app.get_arg_parser().parse_args(args)
+    app.config.update({'IMAGE_HASH': app.FLAG.image_hash})
+    if app.FLAG.page_size is not None:
+        app.config.update({'PAGE_SIZE': app.FLAG.page_size})
+
+    start_auth_updater()
+    start_time = perf_counter()
+    app.start([params['market']])
+    crawl_time = perf_counter() - start_time
+    stop_auth_updater()
+
+    latencies = latencies[:]
+    count = sum(latencies)
+    print(json.dumps({
+        'crawl_seconds': crawl_time,
+        # Summed over the writer processes, writes overlap the crawl
+        'write_seconds': sum(total for _, _, total in WRITE_SECONDS.get_samples()),
+        'output_bytes': _get_dir_size('data'),
+        'requests_measured': count,
+        'p50_ms': _percentile(latencies, count, 50) or 0,
+        'p99_ms': _percentile(latencies, count, 99) or 0,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+    }))
+
+
+def _run_format(flag, server, output_format, project_root):
+    work_dir = tempfile.mkdtemp(prefix='crawl-benchmark-')
+    try:
+        params = {
+            'server': {'url': server.url, 'auth_url': server.auth_url},
+            'workers': flag.workers if flag.workers else max(1, os.cpu_count() - 1),
+            'market': server.catalog.get_market_title(0),
+            'output': output_format,
+            'engine': flag.engine,
+            'stream': flag.stream,
+            'image_hash': flag.image_hash,
+            'page_size': flag.page_size,
+        }
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([project_root, env.get('PYTHONPATH', '')])
+        stats_before = server.get_stats()
+        completed = subprocess.run([sys.executable, '-m', 'scripts.benchmark.crawl_benchmark',
+                                    '--run-one', json.dumps(params)],
+                                   cwd=work_dir, env=env, stdout=subprocess.PIPE, check=True)
+        stats_after = server.get_stats()
+        result = json.loads(completed.stdout.decode('utf-8').strip().splitlines()[-1])
+        for key in ('requests', 'listing_pages', 'images', 'errors', 'throttled', 'auth'):
+            result[key] = stats_after.get(key, 0) - stats_before.get(key, 0)
+        result['pages_per_sec'] = result['listing_pages'] / result['crawl_seconds'] if result['crawl_seconds'] else 0
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _print_report(report):
+    columns = ['format', 'pages', 'pages/sec', 'p50 ms', 'p99 ms', 'peak rss mb', 'worker rss mb', 'write s',
+               'output mb', 'auth', 'errors']
+    print('\t'.join(columns))
+    for output_format, result in report['results'].items():
+        print('\t'.join([output_format,
+                         str(result['listing_pages']),
+                         '{:.1f}'.format(result['pages_per_sec']),
+                         '{:.1f}'.format(result['p50_ms']),
+                         '{:.1f}'.format(result['p99_ms']),
+                         '{:.1f}'.format(result['peak_rss_mb']),
+                         '{:.1f}'.format(result['peak_worker_rss_mb']),
+                         '{:.2f}'.format(result['write_seconds']),
+                         '{:.2f}'.format(result['output_bytes'] / 1024.0 / 1024.0),
+                         str(result['auth']),
+                         str(result['errors'] + result['throttled'])]))
+
+
+def _compare(report, baseline_file, tolerance):
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)
+    regressions = []
+    for output_format, result in report['results'].items():
+        if output_format not in baseline['results']:
+            continue
+        expected = baseline['results'][output_format]['pages_per_sec'] * (1 - tolerance)
+        if result['pages_per_sec'] < expected:
+            regressions.append('{}: {:.1f} pages/sec, expected at least {:.1f}'
+                               .format(output_format, result['pages_per_sec'], expected))
+    return regressions
+
+
+def main():
+    flag = _get_arg_parser().parse_args()
+    if flag.run_one is not None:
+        _run_one(json.loads(flag.run_one))
+        return
+
+    project_root = os.getcwd()
+    catalog = Catalog(categories=flag.categories, sub_categories=flag.sub_categories, l4_units=flag.l4_units,
+                      items=flag.items)
+    server = MockUdaanServer(catalog, port=flag.port, latency=flag.latency_ms / 1000.0,
+                             error_rate=flag.error_rate, throttle_rate=flag.throttle_rate,
+                             max_page_size=flag.max_page_size)
+    try:
+        report = {'settings': dict((k, v) for k, v in vars(flag).items() if k not in ('run_one', 'save', 'compare')),
+                  'results': {}}
+        for output_format in flag.formats:
+            report['results'][output_format] = _run_format(flag, server, output_format, project_root)
+    finally:
+        server.stop()
+
+    _print_report(report)
+    if flag.save:
+        with open(flag.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if flag.compare:
+        regressions = _compare(report, flag.compare, flag.tolerance)
+        if regressions:
+            print('Throughput regression against {}:\n{}'.format(flag.compare, '\n'.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import hashlib
+import io
+import json
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Event, Process
+from threading import Lock
+from time import sleep
+from urllib.parse import parse_qs, urlencode, urlparse
+
+AUTH_PATH = '/auth/token'
+STATS_PATH = '/__stats'
+IMAGES_PATH = '/images/'
+
+
+def _get_image(path):
+    # 32x32 png of blocks seeded by the path, listings of the same product share an image to have duplicates
+    from PIL import Image
+
+    seed = hashlib.sha1(path.rsplit('-', 1)[0].encode('utf-8')).digest()
+    img = Image.frombytes('L', (4, 4), seed[:16]).resize((32, 32), Image.NEAREST).convert('RGB')
+    content = io.BytesIO()
+    img.save(content, format='PNG')
+    return content.getvalue()
+
+
+class Catalog:
+    """
+    Deterministic stand-in for the /market/v1 tree, every leaf target url serving `items` listings.
+    """
+
+    def __init__(self, markets=1, categories=3, sub_categories=4, l4_units=2, items=120):
+        self.markets = markets
+        self.categories = categories
+        self.sub_categories = sub_categories
+        self.l4_units = l4_units
+        self.items = items
+
+    def get_market_title(self, market):
+        return 'Market {}'.format(market + 1)
+
+    def get_tree(self):
+        listing_units = []
+        for m in range(self.markets):
+            l2_units = []
+            for c in range(self.categories):
+                l3_units = []
+                for s in range(self.sub_categories):
+                    l4_units = [{'title': 'Product {}-{}-{}'.format(c + 1, s + 1, p + 1),
+                                 'targetUrl': '/search?' + urlencode({'m': m, 'c': c, 's': s, 'p': p})}
+                                for p in range(self.l4_units)]
+                    l3_units.append({'title': 'Sub Category {}-{}'.format(c + 1, s + 1),
+                                     'targetUrl': '/search?' + urlencode({'m': m, 'c': c, 's': s}),
+                                     'l4Units': l4_units})
+                l2_units.append({'title': 'Category {}'.format(c + 1), 'l3Units': l3_units})
+            listing_units.append({'title': self.get_market_title(m), 'l2Units': l2_units})
+        return {'listingUnits': listing_units}
+
+    def get_listings(self, query, start_value, page_size):
+        key = '-'.join(query.get(k, ['x'])[0] for k in ('m', 'c', 's', 'p'))
+        listings = [{'listingId': '{}-{}'.format(key, i),
+                     'title': 'Listing {} of {}'.format(i, key),
+                     'price': {'value': float(i % 500) + 0.99, 'currency': 'INR'},
+                     'minOrderQty': i % 10 + 1,
+                     'seller': {'id': 'seller-{}'.format(i % 37), 'rating': (i % 5) + 0.5},
+                     'imageUrl': '/images/{}-{}.jpg'.format(key, i)}
+                    for i in range(start_value, min(self.items, start_value + page_size))]
+        return {'numFound': self.items, 'listings': listings}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    catalog = None
+    latency = 0.0
+    error_rate = 0.0
+    throttle_rate = 0.0
+    max_page_size = 100
+    stats = None
+    stats_lock = Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.__count('auth')
+        self.__send_json({'accessToken': 'benchmark-token', 'token_type': 'Bearer', 'expires_in': 900})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == STATS_PATH:
+            with self.stats_lock:
+                self.__send_json(dict(self.stats))
+            return
+
+        self.__count('requests')
+        sleep(self.latency * random.uniform(0.8, 1.2))
+        if random.random() < self.error_rate:
+            self.__count('errors')
+            self.__send_json({'error': 'injected'}, status=500)
+            return
+        if random.random() < self.throttle_rate:
+            self.__count('throttled')
+            self.__send_json({'error': 'throttled'}, status=429, headers={'Retry-After': '1'})
+            return
+
+        if url.path.startswith(IMAGES_PATH):
+            self.__count('images')
+            self.__send(_get_image(url.path), 'image/png')
+        elif url.path == '/market/v1':
+            self.__send_json(self.catalog.get_tree())
+        elif url.path == '/search/v1':
+            query = parse_qs(url.query)
+            start_value = int(query.get('start_value', ['0'])[0])
+            page_size = min(int(query.get('rows', ['12'])[0]), self.max_page_size)
+            self.__count('listing_pages')
+            self.__send_json(self.catalog.get_listings(query, start_value, page_size))
+        else:
+            self.__send_json({'error': 'not found'}, status=404)
+
+    def __count(self, key):
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def __send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        if status == 200:
+            # Revalidation the way the API answers conditional requests of the response cache
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                self.__count('not_modified')
+                self.__send(b'', 'application/json', 304, {'ETag': etag})
+                return
+            headers = dict(headers or {}, ETag=etag)
+        self.__send(body, 'application/json', status, headers)
+
+    def __send(self, body, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _serve(port, catalog, latency, error_rate, throttle_rate, max_page_size, ready):
+    _Handler.catalog = catalog
+    _Handler.latency = latency
+    _Handler.error_rate = error_rate
+    _Handler.throttle_rate = throttle_rate
+    _Handler.max_page_size = max_page_size
+    _Handler.stats = {}
+    server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    server.daemon_threads = True
+    ready.set()
+    server.serve_forever()
+
+
+class MockUdaanServer:
+    """
+    Local HTTP stand-in for api.udaan.com, run in its own process so it does not compete with the crawler for the GIL.
+    """
+
+    def __init__(self, catalog, port=8765, latency=0.05, error_rate=0.0, throttle_rate=0.0, max_page_size=100):
+        self.catalog = catalog
+        self.url = 'http://127.0.0.1:{}'.format(port)
+        self.auth_url = self.url + AUTH_PATH
+        ready = Event()
+        self.__process = Process(target=_serve, daemon=True,
+                                 args=(port, catalog, latency, error_rate, throttle_rate, max_page_size, ready))
+        self.__process.start()
+        if not ready.wait(10) or not self.__process.is_alive():
+            raise RuntimeError('Mock server could not be started on port {}'.format(port))
+
+    def get_stats(self):
+        import requests
+        return requests.get(self.url + STATS_PATH).json()
+
+    def stop(self):
+        self.__process.terminate()
+        self.__process.join()
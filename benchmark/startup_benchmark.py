@@ -0,0 +1,156 @@
+"""
+Start up benchmark of the crawler, how long importing the entry point and a page worker takes and what they load.
+
+Run it from the directory that contains the scripts package, the same way as the crawler itself:
+
+    python -m scripts.benchmark.startup_benchmark --repeat 5 --save startup.json
+    python -m scripts.benchmark.startup_benchmark --compare startup.json
+
+Every target is imported in a fresh interpreter with -X importtime, as a spawned worker would. The report has the best
+wall time and import time over --repeat runs and the slowest packages of the best run. The run fails when a target
+loads one of the lazily imported dependencies, or with --compare when its import time grew more than --tolerance
+over a saved report.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+from scripts.benchmark.crawl_benchmark import _write_config
+
+TARGETS = {
+    'app': ['scripts.app'],
+    # A page worker fetches and decodes pages and writes partition parts, it never builds a data frame
+    'worker': ['scripts.request_util', 'scripts.distributed'],
+}
+
+# Only loaded by the code paths that need them, never at start up
+LAZY_MODULES = ('pandas', 'numpy', 'pyarrow', 'apscheduler', 'tqdm', 'aiohttp', 'PIL')
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser(description='Crawler start up benchmark')
+    parser.add_argument('--targets', nargs='+', default=sorted(TARGETS), choices=sorted(TARGETS))
+    parser.add_argument('--repeat', type=int, default=5, help='Imports per target, the best one is reported')
+    parser.add_argument('--top', type=int, default=10, help='Slowest packages to report per target')
+    parser.add_argument('--save', type=str, default=None, help='Write the report to this json file')
+    parser.add_argument('--compare', type=str, default=None, help='Baseline report to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    return parser
+
+
+def _parse_import_times(stderr):
+    """
+    Returns (name, depth, self us, cumulative us) for every line of the -X importtime report.
+    """
+    import_times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        import_times.append((name.strip(), depth, int(fields[0]), int(fields[1])))
+    return import_times
+
+
+def _import_once(modules, work_dir, env):
+    statement = 'import sys, json\n{}\nprint(json.dumps(sorted(sys.modules)))'.format(
+        '\n'.join('import ' + module for module in modules))
+    start_time = perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=work_dir, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    wall_time = perf_counter() - start_time
+    import_times = _parse_import_times(completed.stderr.decode('utf-8'))
+    loaded = json.loads(completed.stdout.decode('utf-8').strip().splitlines()[-1])
+    return wall_time, import_times, loaded
+
+
+def _run_target(target, repeat, top, work_dir, env):
+    best = None
+    for _ in range(repeat):
+        wall_time, import_times, loaded = _import_once(TARGETS[target], work_dir, env)
+        # Interpreter start up (site, encodings) is the same for every target, only the crawler imports count
+        import_us = sum(cumulative for name, depth, _, cumulative in import_times
+                        if depth == 0 and name.split('.')[0] == 'scripts')
+        if best is None or import_us < best['import_ms'] * 1000:
+            packages = sorted(((name, cumulative) for name, depth, _, cumulative in import_times if '.' not in name),
+                              key=lambda package: -package[1])
+            best = {
+                'import_ms': import_us / 1000.0,
+                'slowest': [[name, cumulative / 1000.0] for name, cumulative in packages[:top]],
+                'modules': len(loaded),
+                'lazy_modules_loaded': sorted(set(name.split('.')[0] for name in loaded) & set(LAZY_MODULES)),
+            }
+        best['wall_ms'] = min(best.get('wall_ms', wall_time * 1000), wall_time * 1000)
+    return best
+
+
+def _print_report(report):
+    print('\t'.join(['target', 'wall ms', 'import ms', 'modules', 'lazy modules loaded']))
+    for target, result in report['results'].items():
+        print('\t'.join([target, '{:.1f}'.format(result['wall_ms']), '{:.1f}'.format(result['import_ms']),
+                         str(result['modules']), ', '.join(result['lazy_modules_loaded']) or '-']))
+    for target, result in report['results'].items():
+        print('\nSlowest packages of {}'.format(target))
+        for name, cumulative in result['slowest']:
+            print('{:>10.1f} ms  {}'.format(cumulative, name))
+
+
+def _get_failures(report, baseline_file, tolerance):
+    failures = []
+    for target, result in report['results'].items():
+        if result['lazy_modules_loaded']:
+            failures.append('{}: imports {} at start up'.format(target, ', '.join(result['lazy_modules_loaded'])))
+    if baseline_file is None:
+        return failures
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)
+    for target, result in report['results'].items():
+        if target not in baseline['results']:
+            continue
+        expected = baseline['results'][target]['import_ms'] * (1 + tolerance)
+        if result['import_ms'] > expected:
+            failures.append('{}: {:.1f} ms import time, expected at most {:.1f} ms'
+                            .format(target, result['import_ms'], expected))
+    return failures
+
+
+def main():
+    flag = _get_arg_parser().parse_args()
+    project_root = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='startup-benchmark-')
+    try:
+        # Importing the crawler needs a config file, nothing is requested from this url
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            _write_config({'url': 'http://127.0.0.1:9', 'auth_url': 'http://127.0.0.1:9/auth'}, 1)
+        finally:
+            os.chdir(cwd)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([project_root, env.get('PYTHONPATH', '')])
+        report = {'settings': {'repeat': flag.repeat, 'python': sys.version.split()[0]}, 'results': {}}
+        for target in flag.targets:
+            report['results'][target] = _run_target(target, flag.repeat, flag.top, work_dir, env)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    _print_report(report)
+    if flag.save:
+        with open(flag.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    failures = _get_failures(report, flag.compare, flag.tolerance)
+    if failures:
+        print('Start up regression:\n{}'.format('\n'.join(failures)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
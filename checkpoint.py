@@ -0,0 +1,100 @@
+import json
+import os
+import sqlite3
+from threading import Lock
+
+import scripts.logger_util as Logger
+from scripts.utils import DEFAULT_PAGE_SIZE, get_configuration, get_page_size, loads_json
+
+config = get_configuration()
+logger = Logger.get_logger(__name__)
+
+
+class CheckpointStore:
+    """
+    Append only record of completed pages and categories of one market crawl, kept in sqlite under the download
+    location so a crashed crawl can be resumed with --resume.
+    """
+
+    def __init__(self, market_type, resume=False):
+        checkpoint_dir = config['DOWNLOAD_LOCATION'] + '.checkpoint'
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        self.file_name = checkpoint_dir + '/' + market_type + '.sqlite'
+        if not resume and os.path.exists(self.file_name):
+            logger.info('Starting a fresh crawl, removing old checkpoint {}'.format(self.file_name))
+            os.remove(self.file_name)
+
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(self.file_name, isolation_level=None, check_same_thread=False)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('PRAGMA synchronous=NORMAL')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS targets '
+                                  '(target_url TEXT PRIMARY KEY, items_found INTEGER NOT NULL)')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS pages '
+                                  '(target_url TEXT NOT NULL, start_value INTEGER NOT NULL, items TEXT NOT NULL, '
+                                  'PRIMARY KEY (target_url, start_value))')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS categories '
+                                  '(market TEXT NOT NULL, category TEXT NOT NULL, output TEXT NOT NULL, '
+                                  'PRIMARY KEY (market, category, output))')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        if resume:
+            logger.info('Resuming crawl from checkpoint {}'.format(self.file_name))
+        self.__check_page_size()
+
+    def get_items_found(self, target_url):
+        with self.__lock:
+            row = self.__connection.execute('SELECT items_found FROM targets WHERE target_url = ?',
+                                            (target_url,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_items_found(self, target_url, items_found):
+        with self.__lock:
+            self.__connection.execute('INSERT OR REPLACE INTO targets VALUES (?, ?)', (target_url, items_found))
+
+    def get_pages(self, target_url):
+        """
+        Returns a dict of start_value -> items of every completed page of the target url.
+        """
+        with self.__lock:
+            rows = self.__connection.execute('SELECT start_value, items FROM pages WHERE target_url = ?',
+                                             (target_url,)).fetchall()
+        return dict((start_value, loads_json(items)) for start_value, items in rows)
+
+    def add_page(self, target_url, start_value, items):
+        with self.__lock:
+            self.__connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)',
+                                      (target_url, start_value, json.dumps(items)))
+
+    def is_category_done(self, market_type, category, output):
+        """
+        Whether the category file was already written for the given output, e.g. 'json' or 'json-stream'.
+        """
+        with self.__lock:
+            row = self.__connection.execute('SELECT 1 FROM categories '
+                                            'WHERE market = ? AND category = ? AND output = ?',
+                                            (market_type, category, output)).fetchone()
+        return row is not None
+
+    def set_category_done(self, market_type, category, output):
+        with self.__lock:
+            self.__connection.execute('INSERT OR REPLACE INTO categories VALUES (?, ?, ?)',
+                                      (market_type, category, output))
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def __check_page_size(self):
+        # Pages are keyed by start_value, they only line up with the pages of this run at the same page size
+        page_size = str(get_page_size())
+        row = self.__connection.execute("SELECT value FROM settings WHERE key = 'page_size'").fetchone()
+        has_pages = self.__connection.execute('SELECT 1 FROM targets LIMIT 1').fetchone() is not None
+        # Checkpoints without the setting were written with the default page size
+        checkpoint_page_size = row[0] if row is not None else str(DEFAULT_PAGE_SIZE)
+        if has_pages and checkpoint_page_size != page_size:
+            logger.warning('Checkpoint {} has pages of {} listings, this run uses {}, crawling its pages again'
+                           .format(self.file_name, checkpoint_page_size, page_size))
+            self.__connection.execute('DELETE FROM pages')
+            self.__connection.execute('DELETE FROM targets')
+        self.__connection.execute("INSERT OR REPLACE INTO settings VALUES ('page_size', ?)", (page_size,))
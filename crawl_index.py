@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sqlite3
+from threading import Lock
+
+import scripts.logger_util as Logger
+from scripts.utils import get_configuration, loads_json
+
+config = get_configuration()
+logger = Logger.get_logger(__name__)
+
+
+def _get_hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CrawlIndex:
+    """
+    Listings of the previous crawls of one market keyed by target url and listing id, used by --incremental to skip
+    unchanged target urls and to emit only added, changed and removed items.
+
+    Items of a target url are fed page by page between begin() and finish(), so the index never needs a whole target
+    url in memory. Every row seen in the current crawl is stamped with the target's new generation, rows left with an
+    older generation at finish() are the removed listings.
+    """
+
+    def __init__(self, market_type):
+        index_dir = config['DOWNLOAD_LOCATION'] + '.index'
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        self.file_name = index_dir + '/' + market_type + '.sqlite'
+        self.__listing_id_key = config.get('LISTING_ID_KEY', 'ListingId')
+        self.__deltas = {}
+        self.__finished_deltas = {}
+
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(self.file_name, check_same_thread=False)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS targets '
+                                  '(target_url TEXT PRIMARY KEY, items_found INTEGER, fingerprint TEXT, '
+                                  'generation INTEGER NOT NULL)')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS listings '
+                                  '(target_url TEXT NOT NULL, listing_key TEXT NOT NULL, hash TEXT NOT NULL, '
+                                  'item TEXT NOT NULL, generation INTEGER NOT NULL, position INTEGER NOT NULL, '
+                                  'PRIMARY KEY (target_url, listing_key))')
+        self.__connection.commit()
+
+    @staticmethod
+    def get_fingerprint(first_page_items):
+        return _get_hash(first_page_items)
+
+    def is_unchanged(self, target_url, items_found, fingerprint):
+        with self.__lock:
+            row = self.__connection.execute('SELECT items_found, fingerprint FROM targets WHERE target_url = ?',
+                                            (target_url,)).fetchone()
+        return row is not None and row[0] == items_found and row[1] == fingerprint
+
+    def get_items(self, target_url):
+        with self.__lock:
+            rows = self.__connection.execute('SELECT item FROM listings WHERE target_url = ? ORDER BY position',
+                                             (target_url,)).fetchall()
+        return [loads_json(item) for item, in rows]
+
+    def begin(self, target_url):
+        with self.__lock:
+            row = self.__connection.execute('SELECT generation FROM targets WHERE target_url = ?',
+                                            (target_url,)).fetchone()
+            generation = row[0] + 1 if row is not None else 1
+            self.__connection.execute('INSERT OR IGNORE INTO targets (target_url, generation) VALUES (?, 0)',
+                                      (target_url,))
+            self.__connection.commit()
+        self.__deltas[target_url] = {'Generation': generation, 'Position': 0, 'Added': [], 'Changed': []}
+
+    def add_items(self, target_url, items):
+        delta = self.__deltas[target_url]
+        with self.__lock:
+            for item in items:
+                item_hash = _get_hash(item)
+                listing_key = str(item[self.__listing_id_key]) if self.__listing_id_key in item else item_hash
+                row = self.__connection.execute('SELECT hash FROM listings WHERE target_url = ? AND listing_key = ?',
+                                                (target_url, listing_key)).fetchone()
+                if row is None:
+                    delta['Added'].append(item)
+                elif row[0] != item_hash:
+                    delta['Changed'].append(item)
+                self.__connection.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?)',
+                                          (target_url, listing_key, item_hash, json.dumps(item),
+                                           delta['Generation'], delta['Position']))
+                delta['Position'] += 1
+            self.__connection.commit()
+
+    def finish(self, target_url, items_found, fingerprint, complete):
+        """
+        Close the crawl of a target url, its delta is then available from pop_delta. When some page failed
+        (complete is False) nothing is reported as removed and the fingerprint is not stored, so the next incremental
+        run fetches the target url again.
+        """
+        delta = self.__deltas.pop(target_url)
+        generation = delta.pop('Generation')
+        delta.pop('Position')
+        with self.__lock:
+            removed = []
+            if complete:
+                rows = self.__connection.execute('SELECT item FROM listings WHERE target_url = ? AND generation < ?',
+                                                 (target_url, generation)).fetchall()
+                removed = [loads_json(item) for item, in rows]
+                self.__connection.execute('DELETE FROM listings WHERE target_url = ? AND generation < ?',
+                                          (target_url, generation))
+            self.__connection.execute('UPDATE targets SET items_found = ?, fingerprint = ?, generation = ? '
+                                      'WHERE target_url = ?',
+                                      (items_found, fingerprint if complete else None, generation, target_url))
+            self.__connection.commit()
+        delta['Removed'] = removed
+        logger.debug('Delta of {} - {} added, {} changed, {} removed'
+                     .format(target_url, len(delta['Added']), len(delta['Changed']), len(removed)))
+        self.__finished_deltas[target_url] = delta
+
+    def pop_delta(self, target_url):
+        """
+        Returns {'Added': [...], 'Changed': [...], 'Removed': [...]} of a finished target url, None when the target url
+        was skipped as unchanged.
+        """
+        return self.__finished_deltas.pop(target_url, None)
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
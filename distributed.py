@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+from multiprocessing import Process
+from time import sleep, time
+
+import scripts.logger_util as Logger
+from scripts.FileWriterUtil import write_partition_part
+from scripts.session_helper import AuthError
+from scripts.utils import *
+
+config = get_configuration()
+logger = Logger.get_logger(__name__)
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class SqliteWorkQueue:
+    """
+    Page level work items of a distributed crawl kept in one sqlite file, a stand-in for a shared queue service.
+
+    Every node opens the same file, so it has to live on a file system with working POSIX locks. Items are leased for
+    WORK_QUEUE_LEASE_SECONDS, the lease of a node that dies is given to the next node asking for work, and an item is
+    marked failed after MAX_RETRY leases that did not complete it.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.__lease_seconds = float(config.get('WORK_QUEUE_LEASE_SECONDS', 300))
+        self.__max_attempts = int(config['MAX_RETRY'])
+        self.__connection = None
+        self.__pid = None
+
+    def put(self, items):
+        """
+        Add work items, dicts of market, category, sub_category, product, target_url, start_value and output.
+        Items already in the queue are left as they are.
+        """
+        connection = self.__get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT OR IGNORE INTO work (market, category, sub_category, product, target_url, '
+                                   'start_value, output, state, attempts, lease_until) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, 0)',
+                                   [(item['market'], item['category'], item['sub_category'], item['product'],
+                                     item['target_url'], item['start_value'], item['output'], PENDING)
+                                    for item in items])
+
+    def lease(self, worker):
+        connection = self.__get_connection()
+        now = time()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT id, market, category, sub_category, product, target_url, start_value, '
+                                     'output FROM work WHERE state = ? OR (state = ? AND lease_until < ?) '
+                                     'ORDER BY id LIMIT 1', (PENDING, LEASED, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE work SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1 '
+                               'WHERE id = ?', (LEASED, worker, now + self.__lease_seconds, row[0]))
+        return dict(zip(('id', 'market', 'category', 'sub_category', 'product', 'target_url', 'start_value',
+                         'output'), row))
+
+    def complete(self, item_id):
+        connection = self.__get_connection()
+        with connection:
+            connection.execute('UPDATE work SET state = ? WHERE id = ?', (DONE, item_id))
+
+    def fail(self, item_id):
+        connection = self.__get_connection()
+        with connection:
+            connection.execute('UPDATE work SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END WHERE id = ?',
+                               (self.__max_attempts, FAILED, PENDING, item_id))
+
+    def clear(self, market_type):
+        connection = self.__get_connection()
+        with connection:
+            connection.execute('DELETE FROM work WHERE market = ?', (market_type,))
+
+    def get_counts(self, market_type=None):
+        """
+        Returns a dict of state -> number of work items, of one market or of the whole queue.
+        """
+        connection = self.__get_connection()
+        if market_type is None:
+            rows = connection.execute('SELECT state, COUNT(*) FROM work GROUP BY state').fetchall()
+        else:
+            rows = connection.execute('SELECT state, COUNT(*) FROM work WHERE market = ? GROUP BY state',
+                                      (market_type,)).fetchall()
+        return dict(rows)
+
+    def close(self):
+        if self.__connection is not None and self.__pid == os.getpid():
+            self.__connection.close()
+        self.__connection = None
+
+    def __get_connection(self):
+        # A sqlite connection must not cross a fork, every worker process opens its own
+        if self.__pid != os.getpid():
+            self.__connection = sqlite3.connect(self.file_name, timeout=60, isolation_level=None)
+            self.__connection.execute('CREATE TABLE IF NOT EXISTS work '
+                                      '(id INTEGER PRIMARY KEY AUTOINCREMENT, market TEXT NOT NULL, '
+                                      'category TEXT NOT NULL, sub_category TEXT NOT NULL, product TEXT NOT NULL, '
+                                      'target_url TEXT NOT NULL, start_value INTEGER NOT NULL, output TEXT NOT NULL, '
+                                      'state TEXT NOT NULL, attempts INTEGER NOT NULL, lease_until REAL NOT NULL, '
+                                      'worker TEXT, '
+                                      'UNIQUE (market, category, sub_category, product, target_url, start_value))')
+            self.__pid = os.getpid()
+        return self.__connection
+
+
+def get_work_queue(url):
+    """
+    Work queue for a --work-queue url, only sqlite:///path/to/queue.sqlite is supported for now.
+    """
+    if url.startswith('sqlite://'):
+        return SqliteWorkQueue(url[len('sqlite://'):])
+    raise ValueError("Unsupported work queue '{}', expected sqlite:///path/to/queue.sqlite".format(url))
+
+
+def is_drained(counts):
+    return sum(counts.values()) > 0 and not counts.get(PENDING) and not counts.get(LEASED)
+
+
+def run_workers(work_queue, get_page, processes):
+    """
+    Run `processes` worker processes on this node until the queue is drained, raises RuntimeError when any of them
+    failed. get_page(target_url, start_value) returns (items found, items) or None, as for the global work scheduler.
+    """
+    state = get_process_state()
+    workers = [Process(target=_work, args=(work_queue, get_page, '{}-{}-{}'.format(socket.gethostname(),
+                                                                                       os.getpid(), i), state))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed_workers = [worker.name for worker in workers if worker.exitcode]
+    if failed_workers:
+        raise RuntimeError('Worker processes {} failed, see the errors above'.format(', '.join(failed_workers)))
+
+
+def _get_part_name(item):
+    key = json.dumps([item['sub_category'], item['product'], item['target_url']])
+    return '{}-{}'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16], item['start_value'])
+
+
+def _work(work_queue, get_page, worker, state):
+    init_process(state)
+    poll_interval = float(config.get('WORK_QUEUE_POLL_INTERVAL', 2))
+    logger.info('Worker {} started'.format(worker))
+    pages = 0
+    while True:
+        item = work_queue.lease(worker)
+        if item is None:
+            # An empty queue means the coordinator has not published yet, keep waiting for it
+            if is_drained(work_queue.get_counts()):
+                break
+            sleep(poll_interval)
+            continue
+
+        try:
+            result = get_page(item['target_url'], item['start_value'])
+        except AuthError:
+            # The item goes back to the queue and this worker exits with an error, no page can be fetched any more
+            work_queue.fail(item['id'])
+            work_queue.close()
+            raise
+        if result is None:
+            logger.error('Failed to get page {} of {}'.format(item['start_value'], item['target_url']))
+            work_queue.fail(item['id'])
+            continue
+        items_found, items = result
+        if item['start_value'] == 0:
+            work_queue.put([dict(item, start_value=start_value) for start_value in get_page_starts(items_found)[1:]])
+        write_partition_part(item['market'], item['category'], _get_part_name(item),
+                             {'Market': item['market'], 'CategoryName': item['category'],
+                              'SubCategoryName': item['sub_category'], 'ProductName': item['product']},
+                             items, item['output'])
+        work_queue.complete(item['id'])
+        pages += 1
+    work_queue.close()
+    logger.info('Worker {} finished, {} pages crawled'.format(worker, pages))
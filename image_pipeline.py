@@ -0,0 +1,76 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import scripts.logger_util as Logger
+from scripts.phash import hash_reduced_images, reduce_image
+from scripts.request_util import get_content_from_url
+from scripts.session_helper import create_public_session
+from scripts.utils import get_configuration
+
+config = get_configuration()
+logger = Logger.get_logger(__name__)
+
+IMAGE_HASH_KEY = 'ImageHash'
+
+_executors = {}
+_sessions = {}
+
+
+def _get_executor():
+    # Threads do not survive a fork, every worker process gets its own bounded downloader
+    pid = os.getpid()
+    if pid not in _executors:
+        _executors.clear()
+        _executors[pid] = ThreadPoolExecutor(max_workers=int(config.get('IMAGE_DOWNLOAD_CONCURRENCY', 8)))
+    return _executors[pid]
+
+
+def _get_session():
+    # Images are usually served by a CDN, they are fetched without the API cookies and bearer token
+    pid = os.getpid()
+    if pid not in _sessions:
+        _sessions.clear()
+        _sessions[pid] = create_public_session()
+    return _sessions[pid]
+
+
+def _get_image_url(value):
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        value = value.get('url')
+    if not isinstance(value, str) or not value:
+        return None
+    return urljoin(config['BASE_URL'], value)
+
+
+def add_image_hashes(items):
+    """
+    Download the image of every item and store its phash.hash_images hash as 16 hex digits under ImageHash, or None
+    when the item has no image or it could not be fetched or decoded. Images are fetched concurrently over one
+    session without API credentials and decoded in memory by the same threads, only the 8x8 reductions are kept.
+    """
+    image_url_key = config.get('IMAGE_URL_KEY', 'ImageUrl')
+    image_urls = [_get_image_url(item.get(image_url_key)) for item in items]
+    if not any(image_urls):
+        return items
+
+    session_obj = _get_session()
+
+    def get_reduced_image(image_url):
+        if image_url is None:
+            return None
+        content = get_content_from_url(image_url, session_obj=session_obj)
+        if not content:
+            return None
+        reduced = reduce_image(content)
+        if reduced is None:
+            logger.warning('Could not decode image {}'.format(image_url))
+        return reduced
+
+    reduced_images = list(_get_executor().map(get_reduced_image, image_urls))
+    hashes, decoded = hash_reduced_images(reduced_images)
+    for item, image_hash, is_decoded in zip(items, hashes, decoded):
+        item[IMAGE_HASH_KEY] = '{:016x}'.format(int(image_hash)) if is_decoded else None
+    return items
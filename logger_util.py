@@ -1,14 +1,170 @@
+import atexit
+import json
 import logging
+import os
+import sys
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Queue, parent_process
+
+from scripts.utils import register_process_state
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_FORMATS = ('text', 'json')
+
+_level = logging.INFO
+_log_format = 'text'
+_repeat_limit = 10
+_repeat_window = 60.0
+
+# Every process puts its records on one queue, a listener thread of the main process formats and writes them, so a
+# logging call only pickles the record and the workers never contend for stderr. The workers get the queue through
+# get_process_pool.
+_queue = None
+_stream_handler = logging.StreamHandler(sys.stderr)
+_listener = None
+_listener_pid = os.getpid()
+_listening = False
+_logger_names = set()
+
+
+class _TextFormatter(logging.Formatter):
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+
+    def format(self, record):
+        message = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            message += ' [{} similar messages suppressed]'.format(suppressed)
+        return message
+
+
+class _JsonFormatter(logging.Formatter):
+    # One json object per line, with the fields log shippers index on
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        return json.dumps(entry)
+
+
+class _RepeatFilter(logging.Filter):
+    """
+    Lets at most LOG_REPEAT_LIMIT warnings and errors of one call site through per LOG_REPEAT_WINDOW seconds in each
+    process, so a failing endpoint logs a sample of its per page errors instead of every one. The next record of the
+    call site after the window carries the number of records that were dropped.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.__lock = threading.Lock()
+        self.__sites = {}
+        self.__pid = os.getpid()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or _repeat_limit <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        with self.__lock:
+            if self.__pid != os.getpid():
+                # Counts of the parent do not apply to a forked worker
+                self.__sites = {}
+                self.__pid = os.getpid()
+            site = self.__sites.get(key)
+            if site is None or record.created - site[0] >= _repeat_window:
+                if site is not None and site[1] > _repeat_limit:
+                    record.suppressed = site[1] - _repeat_limit
+                self.__sites[key] = [record.created, 1]
+                return True
+            site[1] += 1
+            return site[1] <= _repeat_limit
+
+
+class _QueueHandler(QueueHandler):
+    # A spawned process writes its records itself until the initializer of its pool hands it the queue
+    def emit(self, record):
+        if self.queue is None:
+            _stream_handler.handle(record)
+        else:
+            super().emit(record)
+
+
+_queue_handler = _QueueHandler(None)
+_queue_handler.addFilter(_RepeatFilter())
+_stream_handler.setFormatter(_TextFormatter())
 
 
 def get_logger(name):
     logger = logging.getLogger(name)
+    if _queue_handler not in logger.handlers:
+        logger.addHandler(_queue_handler)
+        # Third party loggers keep their own handlers, ours only go through the queue
+        logger.propagate = False
+    logger.setLevel(_level)
+    _logger_names.add(name)
+    return logger
 
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter(
-        '%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
 
-    return logger
+def configure_logging(level=None, log_format=None, repeat_limit=None, repeat_window=None):
+    """
+    Set the level, the format ('text' or 'json') and the repetition limit of every logger, in this process and in the
+    worker processes started after this call.
+    """
+    global _level, _log_format, _repeat_limit, _repeat_window
+    if level is not None:
+        _level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+        for name in _logger_names:
+            logging.getLogger(name).setLevel(_level)
+    if log_format is not None:
+        _log_format = log_format
+        _stream_handler.setFormatter(_JsonFormatter() if log_format == 'json' else _TextFormatter())
+    if repeat_limit is not None:
+        _repeat_limit = int(repeat_limit)
+    if repeat_window is not None:
+        _repeat_window = float(repeat_window)
+
+
+def stop_logging():
+    """
+    Write every queued record and stop the listener, called once the run is over.
+    """
+    global _listening
+    if os.getpid() == _listener_pid and _listening:
+        _listening = False
+        _listener.stop()
+
+
+def _start_listener():
+    global _queue, _listener, _listening
+    _queue = Queue(-1)
+    _queue_handler.queue = _queue
+    _listener = QueueListener(_queue, _stream_handler)
+    _listener.start()
+    _listening = True
+    atexit.register(stop_logging)
+
+
+def _get_state():
+    return _queue, _level, _log_format, _repeat_limit, _repeat_window
+
+
+def _set_state(state):
+    queue, level, log_format, repeat_limit, repeat_window = state
+    _queue_handler.queue = queue
+    configure_logging(level, log_format, repeat_limit, repeat_window)
+
+
+register_process_state(__name__, _get_state, _set_state)
+
+# Only the main process listens, a spawned worker imports this module again and must not start a listener of its own
+if parent_process() is None:
+    _start_listener()
@@ -0,0 +1,365 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import product
+from multiprocessing import Array, Lock
+from time import perf_counter, time
+
+import scripts.logger_util as Logger
+from scripts.utils import register_process_state
+
+logger = Logger.get_logger(__name__)
+
+ENDPOINTS = ('market', 'listing', 'image')
+STATUSES = ('200', '304', '401', '403', '404', '429', '500', '502', '503', '504', 'error')
+OUTPUT_FORMATS = ('json', 'csv', 'excel', 'parquet', 'arrow')
+STAGES = ('market_tree', 'category', 'page', 'image_hash', 'write')
+# Label value every unknown value is counted under, the shared arrays are sized up front
+OTHER = 'other'
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Every metric lives in shared memory allocated when the parent imports this module. The worker processes get the same
+# memory through get_process_pool, so the parent sees the totals of every worker
+_lock = Lock()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, description, label_names=(), label_values=(), width=1):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.__keys = list(product(*[tuple(values) + (OTHER,) for values in label_values]))
+        self.__positions = dict((key, i) for i, key in enumerate(self.__keys))
+        self.__label_values = [set(values) for values in label_values]
+        self._width = width
+        self._values = Array('d', len(self.__keys) * width, lock=False)
+
+    def _get_offset(self, label_values):
+        position = self.__positions.get(label_values)
+        if position is None:
+            position = self.__positions[tuple(value if value in values else OTHER
+                                              for value, values in zip(label_values, self.__label_values))]
+        return position * self._width
+
+    def _get_rows(self):
+        # (label values, raw values) of every label combination seen so far
+        with _lock:
+            values = self._values[:]
+        rows = []
+        for i, key in enumerate(self.__keys):
+            row = values[i * self._width:(i + 1) * self._width]
+            if any(row):
+                rows.append((key, row))
+        return rows
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        offset = self._get_offset(tuple(str(value) for value in label_values))
+        with _lock:
+            self._values[offset] += amount
+
+    def get(self, *label_values):
+        return self._values[self._get_offset(tuple(str(value) for value in label_values))]
+
+    def get_samples(self):
+        return [(key, row[0]) for key, row in self._get_rows()]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, label_names=(), label_values=(), buckets=SECONDS_BUCKETS):
+        # per label combination the count of every bucket, the +Inf bucket and the sum
+        super().__init__(name, description, label_names, label_values, len(buckets) + 2)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        offset = self._get_offset(tuple(str(v) for v in label_values))
+        with _lock:
+            self._values[offset + bisect_left(self.buckets, value)] += 1
+            self._values[offset + self._width - 1] += value
+
+    def get_samples(self):
+        """
+        Returns (label values, bucket counts including +Inf, sum) of every label combination seen so far.
+        """
+        return [(key, row[:-1], row[-1]) for key, row in self._get_rows()]
+
+    def get_quantile(self, counts, quantile):
+        # Linear interpolation inside the bucket the quantile falls in, as Prometheus' histogram_quantile
+        rank = quantile * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+
+REQUESTS = Counter('crawler_requests_total', 'Requests sent by endpoint and status code, error when no response',
+                   ('endpoint', 'status'), (ENDPOINTS, STATUSES))
+RETRIES = Counter('crawler_request_retries_total', 'Requests sent again after a failed attempt', ('endpoint',),
+                  (ENDPOINTS,))
+REQUEST_SECONDS = Histogram('crawler_request_seconds', 'Request latency by endpoint', ('endpoint',), (ENDPOINTS,))
+AUTH_REFRESH_SECONDS = Histogram('crawler_auth_refresh_seconds', 'Duration of auth token refreshes')
+SESSION_CREATE_SECONDS = Histogram('crawler_session_create_seconds', 'Time spent creating pooled sessions, one '
+                                   'observation per session created')
+SESSION_POOL_SIZE = Gauge('crawler_session_pool_size', 'Pooled sessions open in every process, idle or in use')
+SESSIONS_IN_USE = Gauge('crawler_sessions_in_use', 'Pooled sessions handed out to a request')
+SESSIONS_EVICTED = Counter('crawler_sessions_evicted_total', 'Pooled sessions replaced after connection errors')
+CONNECTIONS = Counter('crawler_connections_total', 'Connections opened and reused by the pooled sessions', ('kind',),
+                      (('new', 'reused'),))
+PAGES = Counter('crawler_pages_total', 'Listing pages turned into items')
+ITEMS = Counter('crawler_items_total', 'Listing items crawled')
+WRITE_SECONDS = Histogram('crawler_write_seconds', 'Time spent writing output files by format', ('format',),
+                          (OUTPUT_FORMATS,))
+WRITTEN_BYTES = Counter('crawler_written_bytes_total', 'Bytes of output files written by format', ('format',),
+                        (OUTPUT_FORMATS,))
+UNCOMPRESSED_BYTES = Counter('crawler_uncompressed_bytes_total', 'Bytes of output files before compression by format',
+                             ('format',), (OUTPUT_FORMATS,))
+WRITER_WAIT_SECONDS = Histogram('crawler_writer_wait_seconds', 'Time the crawl waited for a free writer slot')
+STAGE_SECONDS = Histogram('crawler_stage_seconds', 'Time spent in each crawl stage', ('stage',), (STAGES,))
+
+METRICS = (REQUESTS, RETRIES, REQUEST_SECONDS, AUTH_REFRESH_SECONDS, SESSION_CREATE_SECONDS, SESSION_POOL_SIZE,
+           SESSIONS_IN_USE, SESSIONS_EVICTED, CONNECTIONS, PAGES, ITEMS, WRITE_SECONDS, WRITTEN_BYTES,
+           UNCOMPRESSED_BYTES, WRITER_WAIT_SECONDS, STAGE_SECONDS)
+
+_started_at = time()
+_profile_dir = None
+_profiles = {}
+_active_stages = threading.local()
+
+
+def _get_state():
+    return _lock, [metric._values for metric in METRICS], _profile_dir
+
+
+def _set_state(state):
+    global _lock, _profile_dir
+    _lock, values, _profile_dir = state
+    for metric, metric_values in zip(METRICS, values):
+        metric._values = metric_values
+
+
+register_process_state(__name__, _get_state, _set_state)
+
+
+def record_request(endpoint, status, seconds, retried=False):
+    REQUESTS.inc(endpoint, status if status is not None else 'error')
+    REQUEST_SECONDS.observe(seconds, endpoint)
+    if retried:
+        RETRIES.inc(endpoint)
+
+
+def record_write(output_format, file_name, seconds, uncompressed_bytes=None):
+    """
+    uncompressed_bytes is the size before streaming compression, None when the file is not compressed as a whole.
+    seconds is None for a further file of a write that is timed with its first file.
+    """
+    if seconds is not None:
+        WRITE_SECONDS.observe(seconds, output_format)
+    if file_name is not None and os.path.exists(file_name):
+        size = os.path.getsize(file_name)
+        WRITTEN_BYTES.inc(output_format, amount=size)
+        UNCOMPRESSED_BYTES.inc(output_format, amount=size if uncompressed_bytes is None else uncompressed_bytes)
+
+
+def enable_profiling(profile_dir):
+    """
+    Profile every stage with cProfile from now on, in this process and in the worker processes started after this
+    call. Each process dumps <stage>-<pid>.prof into profile_dir, merge_profiles combines them per stage.
+    """
+    global _profile_dir
+    os.makedirs(profile_dir, exist_ok=True)
+    _profile_dir = profile_dir
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a crawl stage into crawler_stage_seconds and profile it when profiling is enabled. Only the outermost stage
+    of a thread is profiled, nested stages are part of its profile.
+    """
+    profile = _acquire_profile(name)
+    start_time = perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(perf_counter() - start_time, name)
+        if profile is not None:
+            _release_profile(name, profile)
+
+
+def _acquire_profile(name):
+    # Worker processes forked inside a profiled stage inherit the thread local of the thread that forked them
+    if _profile_dir is None or getattr(_active_stages, 'pid', None) == os.getpid():
+        return None
+    key = (name, os.getpid())
+    if key not in _profiles:
+        _profiles[key] = (cProfile.Profile(), threading.Lock())
+    profile, lock = _profiles[key]
+    # A cProfile.Profile can only profile one thread at a time, the stage is just timed in the others
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12+ allows a single active profiler per process
+        lock.release()
+        return None
+    _active_stages.pid = os.getpid()
+    return profile
+
+
+def _release_profile(name, profile):
+    profile.disable()
+    _active_stages.pid = None
+    # Dumped after every stage, worker processes are terminated without a chance to dump at exit
+    profile.dump_stats('{}{}-{}.prof'.format(_profile_dir, name, os.getpid()))
+    _profiles[(name, os.getpid())][1].release()
+
+
+def merge_profiles():
+    """
+    Combine the per process dumps of each stage into <stage>.prof and log the top functions by cumulative time.
+    """
+    if _profile_dir is None:
+        return
+    for name in STAGES:
+        file_names = glob('{}{}-*.prof'.format(_profile_dir, name))
+        if not file_names:
+            continue
+        stats = pstats.Stats(*file_names)
+        stats.dump_stats('{}{}.prof'.format(_profile_dir, name))
+        for file_name in file_names:
+            os.remove(file_name)
+        logger.info("Profile of '{}' stage from {} processes saved into {}{}.prof"
+                    .format(name, len(file_names), _profile_dir, name))
+
+
+def get_summary():
+    """
+    Every metric as a JSON friendly dict nested by label values, histograms as count / sum / p50 / p99 seconds.
+    """
+    elapsed = time() - _started_at
+    summary = {'started_at': datetime.fromtimestamp(_started_at).isoformat(), 'elapsed_seconds': round(elapsed, 3)}
+    for metric in METRICS:
+        values = {}
+        for sample in metric.get_samples():
+            if isinstance(metric, Histogram):
+                key, counts, total = sample
+                value = {'count': int(sum(counts)), 'sum': round(total, 6),
+                         'p50': round(metric.get_quantile(counts, 0.5), 6),
+                         'p99': round(metric.get_quantile(counts, 0.99), 6)}
+            else:
+                key, value = sample
+                value = int(value) if value == int(value) else value
+            if not key:
+                values = value
+                continue
+            node = values
+            for label_value in key[:-1]:
+                node = node.setdefault(label_value, {})
+            node[key[-1]] = value
+        summary[metric.name] = values
+    pages = summary[PAGES.name] or 0
+    summary['pages_per_second'] = round(pages / elapsed, 3) if elapsed else 0.0
+    return summary
+
+
+def write_summary(file_name):
+    summary = get_summary()
+    with open(file_name, 'w') as file:
+        json.dump(summary, file, indent=2)
+    logger.info('Run summary saved into {}, {} pages at {} pages/sec'
+                .format(file_name, summary[PAGES.name] or 0, summary['pages_per_second']))
+    return summary
+
+
+def get_prometheus_text():
+    lines = []
+    for metric in METRICS:
+        lines.append('# HELP {} {}'.format(metric.name, metric.description))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        for sample in metric.get_samples():
+            labels = list(zip(metric.label_names, sample[0]))
+            if isinstance(metric, Counter):
+                lines.append('{}{} {}'.format(metric.name, _format_labels(labels), _format_value(sample[1])))
+                continue
+            _, counts, total = sample
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(metric.name, _format_labels(labels + [('le', str(bound))]),
+                                                     _format_value(cumulative)))
+            lines.append('{}_sum{} {}'.format(metric.name, _format_labels(labels), _format_value(total)))
+            lines.append('{}_count{} {}'.format(metric.name, _format_labels(labels), _format_value(cumulative)))
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            self.__send(get_prometheus_text().encode('utf-8'), 'text/plain; version=0.0.4')
+        elif path == '/metrics.json':
+            self.__send(json.dumps(get_summary()).encode('utf-8'), 'application/json')
+        else:
+            self.__send(b'not found', 'text/plain', 404)
+
+    def __send(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port):
+    """
+    Serve /metrics in the Prometheus text format and /metrics.json as the run summary on localhost, from a daemon
+    thread of this process.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info('Serving metrics on http://127.0.0.1:{}/metrics'.format(server.server_address[1]))
+    return server
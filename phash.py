@@ -1,14 +1,19 @@
+import io
 import numpy as np
 import os,sys
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
+HASH_SIZE = 8
+GREY_WEIGHTS = np.array([0.299, 0.587, 0.114])
+
 def reduceimg(img):
     outfile = os.path.splitext(img)[0] + "_" + ".jpeg"
     try:
         # reduced image dimensions
         size = (8,8)
         img = Image.open(img)
-        img = img.resize(size, Image.ANTIALIAS)
+        img = img.resize(size, Image.LANCZOS)
         return img
     except IOError:
         raise Exception("Bad File")
@@ -73,6 +78,44 @@ def isdifferent(dif):
     else:
         print("These images, from preliminary results are different.")
 
+# decodes one image path or bytes and reduces it to its 8x8 grey values
+# and the average used by main(), None when it can not be decoded
+def reduce_image(image, draft=False):
+    try:
+        img = Image.open(io.BytesIO(image) if isinstance(image, (bytes, bytearray)) else image)
+        if draft:
+            # jpeg only, decodes at a reduced scale, much faster but can differ in a few bits
+            img.draft('RGB', (HASH_SIZE * 8, HASH_SIZE * 8))
+        img = img.resize((HASH_SIZE, HASH_SIZE), Image.LANCZOS)
+        average = np.asarray(img.convert('1'), dtype=np.float64).mean() * 255
+        grey = np.asarray(img.convert('RGB'), dtype=np.float64).reshape(-1, 3) @ GREY_WEIGHTS
+        return grey, average
+    except (IOError, ValueError, SyntaxError):
+        return None
+
+# hashes many image paths or bytes at once, images are decoded in a thread pool
+# and hashed together with numpy.
+# returns the hashes packed as uint64, first pixel as the highest bit like the
+# hex value printed by main(), and a bool array of the images that were decoded
+def hash_images(images, workers=None, draft=False):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return hash_reduced_images(list(executor.map(lambda image: reduce_image(image, draft), images)))
+
+# same as hash_images for images already reduced with reduce_image,
+# for callers that decode in their own threads
+def hash_reduced_images(reduced_images):
+    greys = np.zeros((len(reduced_images), HASH_SIZE * HASH_SIZE))
+    averages = np.zeros(len(reduced_images))
+    decoded = np.zeros(len(reduced_images), dtype=bool)
+    for i, reduced in enumerate(reduced_images):
+        if reduced is not None:
+            greys[i], averages[i] = reduced
+            decoded[i] = True
+    bits = greys > averages[:, None]
+    hashes = np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+    hashes[~decoded] = 0
+    return hashes, decoded
+
 def main():
     # reduces image, greyscales
     # averages and then hashes image
@@ -102,4 +145,4 @@ def main():
     return
 
 if __name__ == "__main__":
-main()
\ No newline at end of file
+    main()
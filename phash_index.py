@@ -0,0 +1,164 @@
+from itertools import combinations
+
+import numpy as np
+
+# isdifferent() thresholds as inclusive max distances, hashes closer than 10 bits are the same image
+SAME_DISTANCE = 9
+SIMILAR_DISTANCE = 19
+ROUGHLY_SIMILAR_DISTANCE = 24
+
+def hamming_distance(hashes, other_hashes):
+    """
+    Number of differing bits between packed uint64 hashes, element wise with numpy broadcasting.
+    """
+    x = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.asarray(other_hashes, dtype=np.uint64))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype(np.int64)
+    # SWAR popcount for numpy < 2
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return ((x * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
+
+
+def _get_masks(block_bits, max_distance):
+    # every block_bits wide xor mask with at most max_distance bits set
+    masks = [0]
+    for distance in range(1, min(block_bits, max_distance) + 1):
+        masks += [sum(1 << bit for bit in bits) for bits in combinations(range(block_bits), distance)]
+    return np.array(masks, dtype=np.uint64)
+
+
+class HashIndex:
+    """
+    Multi-index hashing over packed 64 bit image hashes, as returned by phash.hash_images.
+
+    Each hash is split into `blocks` blocks with one sorted table per block. Two hashes within max_distance bits
+    agree within max_distance // blocks bits on at least one block, so only the table entries next to those block
+    values are compared. Equal hashes are stored once, ids are the positions in the hashes the index was built from.
+    """
+
+    def __init__(self, hashes, blocks=4):
+        if 64 % blocks:
+            raise ValueError('blocks must divide 64, got {}'.format(blocks))
+        self.blocks = blocks
+        self.__block_bits = 64 // blocks
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.__unique_hashes, self.__inverse = np.unique(self.hashes, return_inverse=True)
+        self.__inverse = self.__inverse.ravel()
+        self.__id_order = np.argsort(self.__inverse, kind='stable')
+        self.__id_starts = np.searchsorted(self.__inverse[self.__id_order], np.arange(len(self.__unique_hashes) + 1))
+
+        self.__block_keys = []
+        self.__block_orders = []
+        for block in range(blocks):
+            keys = self.__get_block_keys(self.__unique_hashes, block)
+            order = np.argsort(keys, kind='stable')
+            self.__block_keys.append(keys[order])
+            self.__block_orders.append(order)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def query(self, image_hash, max_distance):
+        """
+        Returns (ids, distances) of every indexed hash within max_distance bits of image_hash, nearest first.
+        """
+        image_hash = np.array([image_hash], dtype=np.uint64)
+        masks = _get_masks(self.__block_bits, max_distance // self.blocks)
+        candidates = []
+        for block in range(self.blocks):
+            keys = self.__get_block_keys(image_hash, block)[0] ^ masks
+            sorted_keys = self.__block_keys[block]
+            starts = np.searchsorted(sorted_keys, keys, side='left')
+            ends = np.searchsorted(sorted_keys, keys, side='right')
+            candidates.append(self.__block_orders[block][_get_ranges(starts, ends)])
+        candidates = np.unique(np.concatenate(candidates))
+        distances = hamming_distance(self.__unique_hashes[candidates], image_hash[0])
+        matches = np.argsort(distances[distances <= max_distance], kind='stable')
+        candidates = candidates[distances <= max_distance][matches]
+        distances = distances[distances <= max_distance][matches]
+
+        counts = self.__id_starts[candidates + 1] - self.__id_starts[candidates]
+        ids = self.__id_order[_get_ranges(self.__id_starts[candidates], self.__id_starts[candidates + 1])]
+        return ids, np.repeat(distances, counts)
+
+    def cluster(self, max_distance):
+        """
+        Label every indexed hash with a cluster id, hashes linked by a chain of pairs within max_distance bits share
+        one. Use SAME_DISTANCE, SIMILAR_DISTANCE or ROUGHLY_SIMILAR_DISTANCE for the isdifferent() levels.
+        """
+        labels = np.arange(len(self.__unique_hashes))
+        for left, right in self.__get_pairs(max_distance):
+            labels = _merge_labels(labels, left, right)
+        _, labels = np.unique(labels, return_inverse=True)
+        return labels.ravel()[self.__inverse]
+
+    def save(self, file_name):
+        np.savez(file_name, hashes=self.hashes, blocks=np.array(self.blocks))
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as data:
+            return cls(data['hashes'], int(data['blocks']))
+
+    def __get_block_keys(self, hashes, block):
+        return (hashes >> np.uint64(block * self.__block_bits)) & np.uint64((1 << self.__block_bits) - 1)
+
+    def __get_pairs(self, max_distance):
+        # Yields (left, right) arrays of unique hash positions within max_distance, a chunk at a time
+        count = len(self.__unique_hashes)
+        masks = _get_masks(self.__block_bits, max_distance // self.blocks)
+        index_cost = self.blocks * len(masks) * (count + count * count / 2.0 ** self.__block_bits)
+        if index_cost >= count * count / 2.0:
+            # Large distances make the tables slower than comparing every pair
+            chunk_size = max(1, 2 ** 24 // max(count, 1))
+            for start in range(0, count, chunk_size):
+                left = np.arange(start, min(count, start + chunk_size))
+                distances = hamming_distance(self.__unique_hashes[left][:, None], self.__unique_hashes[None, :])
+                left, right = np.nonzero(distances <= max_distance)
+                left += start
+                yield left[left < right], right[left < right]
+            return
+
+        for block in range(self.blocks):
+            sorted_keys = self.__block_keys[block]
+            order = self.__block_orders[block]
+            for mask in masks:
+                # Every pair of different keys is looked up once, from its smaller key
+                rows = np.arange(count) if mask == 0 else np.nonzero(sorted_keys < sorted_keys ^ mask)[0]
+                starts = np.searchsorted(sorted_keys, sorted_keys[rows] ^ mask, side='left')
+                ends = np.searchsorted(sorted_keys, sorted_keys[rows] ^ mask, side='right')
+                left = order[np.repeat(rows, ends - starts)]
+                right = order[_get_ranges(starts, ends)]
+                keep = left < right if mask == 0 else slice(None)
+                left, right = left[keep], right[keep]
+                keep = hamming_distance(self.__unique_hashes[left], self.__unique_hashes[right]) <= max_distance
+                yield left[keep], right[keep]
+
+
+def _get_ranges(starts, ends):
+    # concatenation of arange(start, end) for every start / end pair, without a python loop
+    lengths = ends - starts
+    if not lengths.sum():
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(ends - np.cumsum(lengths), lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+def _merge_labels(labels, left, right):
+    # union find over label arrays, labels always point at the root of their cluster, the roots of every pair take
+    # the smaller of the two and are followed again until nothing changes
+    while len(left):
+        left_roots, right_roots = labels[left], labels[right]
+        smaller = np.minimum(left_roots, right_roots)
+        np.minimum.at(labels, left_roots, smaller)
+        np.minimum.at(labels, right_roots, smaller)
+        while True:
+            parents = labels[labels]
+            if np.array_equal(parents, labels):
+                break
+            labels = parents
+        keep = labels[left] != labels[right]
+        left, right = left[keep], right[keep]
+    return labels
@@ -0,0 +1,189 @@
+import random
+from email.utils import parsedate_to_datetime
+from math import ceil, floor, isinf
+from multiprocessing import Lock, Value
+from time import sleep, time
+
+import scripts.logger_util as Logger
+from scripts.utils import get_configuration, register_process_state
+
+config = get_configuration()
+logger = Logger.get_logger(__name__)
+
+SUCCESS = 'success'
+THROTTLED = 'throttled'
+FAILED = 'failed'
+
+# 403 is what the API answers with when it throttles without a 429
+THROTTLE_STATUS_CODES = (403, 429, 500, 502, 503, 504)
+
+
+class _AdaptiveRateLimiter:
+    """
+    Token bucket plus a concurrency limit, shared by every worker process.
+
+    The state lives in shared memory allocated by the parent and handed to the workers by get_process_pool. Both limits
+    start uncapped, so the worker processes or the --concurrency of the async engine are the only bound until the
+    server pushes back. The first throttle (429 / 403 / 5xx / timeout) of a RATE_LIMIT_WINDOW halves both, starting
+    from the rate and concurrency actually seen, and Retry-After pauses every worker; the other throttles of the same
+    window are answers to requests sent before the cut. Every window without a throttle raises both by a quarter
+    again, up to RATE_LIMIT_MAX / CONCURRENCY_MAX when those are set.
+    """
+
+    def __init__(self):
+        self.__min_rate = float(config.get('RATE_LIMIT_MIN', 1))
+        self.__max_rate = float(config.get('RATE_LIMIT_MAX', 'inf'))
+        self.__min_concurrency = float(config.get('CONCURRENCY_MIN', 1))
+        self.__max_concurrency = float(config.get('CONCURRENCY_MAX', 'inf'))
+        self.__window = float(config.get('RATE_LIMIT_WINDOW', 1))
+
+        now = time()
+        self.__lock = Lock()
+        self.__rate = Value('d', min(self.__max_rate, float(config.get('RATE_LIMIT_INITIAL', 'inf'))), lock=False)
+        self.__tokens = Value('d', 1.0, lock=False)
+        self.__last_refill = Value('d', now, lock=False)
+        self.__pause_until = Value('d', 0.0, lock=False)
+        self.__concurrency = Value('d', min(self.__max_concurrency, float(config.get('CONCURRENCY_INITIAL', 'inf'))),
+                                   lock=False)
+        self.__in_flight = Value('l', 0, lock=False)
+        # Requests sent in the current window and the rate of the previous one, the rate a throttle cuts from
+        self.__window_start = Value('d', now, lock=False)
+        self.__window_requests = Value('l', 0, lock=False)
+        self.__sent_rate = Value('d', 0.0, lock=False)
+        self.__last_decrease = Value('d', 0.0, lock=False)
+        self.__last_increase = Value('d', now, lock=False)
+
+    def reserve(self):
+        """
+        Take a request slot if one is free. Returns 0 when the caller may send now, otherwise the seconds to wait
+        before asking again.
+        """
+        with self.__lock:
+            now = time()
+            if now < self.__pause_until.value:
+                return self.__pause_until.value - now
+            if self.__in_flight.value >= self.__concurrency.value:
+                return 0.05
+            if not isinf(self.__rate.value):
+                self.__tokens.value = min(max(self.__rate.value, 1.0),
+                                          self.__tokens.value + (now - self.__last_refill.value) * self.__rate.value)
+                self.__last_refill.value = now
+                if self.__tokens.value < 1:
+                    return (1 - self.__tokens.value) / self.__rate.value
+                self.__tokens.value -= 1
+            self.__in_flight.value += 1
+            self.__count_request(now)
+            return 0
+
+    def acquire(self):
+        wait = self.reserve()
+        while wait:
+            sleep(wait)
+            wait = self.reserve()
+
+    def release(self, outcome, retry_after=None):
+        with self.__lock:
+            now = time()
+            self.__in_flight.value -= 1
+            if outcome == THROTTLED:
+                if retry_after:
+                    self.__pause_until.value = max(self.__pause_until.value, now + retry_after)
+                if now - self.__last_decrease.value >= self.__window:
+                    self.__decrease(now)
+                    logger.debug('Throttled, rate {:.2f}/s, concurrency {:.0f}, retry after {}'
+                                 .format(self.__rate.value, self.__concurrency.value, retry_after))
+            elif outcome == SUCCESS and now - max(self.__last_decrease.value,
+                                                  self.__last_increase.value) >= self.__window:
+                self.__increase(now)
+
+    def get_state(self):
+        """
+        Returns (requests per second, concurrency limit, in flight requests), inf for a limit that is not capped.
+        """
+        with self.__lock:
+            return self.__rate.value, self.__concurrency.value, self.__in_flight.value
+
+    def __count_request(self, now):
+        elapsed = now - self.__window_start.value
+        if elapsed >= self.__window:
+            self.__sent_rate.value = self.__window_requests.value / elapsed
+            self.__window_start.value = now
+            self.__window_requests.value = 0
+        self.__window_requests.value += 1
+
+    def __decrease(self, now):
+        # An uncapped limit is cut from what was actually used, in flight counting the request just released. A capped
+        # one is cut from the limit, the rate sent while a Retry-After pause holds every worker is no measure of it.
+        if isinf(self.__concurrency.value):
+            self.__concurrency.value = self.__in_flight.value + 1
+        if isinf(self.__rate.value):
+            elapsed = now - self.__window_start.value
+            self.__rate.value = max(self.__sent_rate.value, self.__window_requests.value / elapsed if elapsed else 0.0)
+        self.__concurrency.value = max(self.__min_concurrency, floor(self.__concurrency.value / 2))
+        self.__rate.value = max(self.__min_rate, self.__rate.value / 2)
+        self.__tokens.value = min(self.__tokens.value, 1.0)
+        self.__last_refill.value = now
+        self.__last_decrease.value = now
+
+    def __increase(self, now):
+        if not isinf(self.__concurrency.value):
+            self.__concurrency.value = min(self.__max_concurrency, ceil(self.__concurrency.value * 1.25))
+        if not isinf(self.__rate.value):
+            self.__rate.value = min(self.__max_rate, self.__rate.value * 1.25)
+        self.__last_increase.value = now
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """
+    The limiter shared by every process. It is created on first use, after the command line has updated the settings,
+    and at the latest by the parent when it creates a pool, so every worker gets the same one.
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = _AdaptiveRateLimiter()
+    return _rate_limiter
+
+
+def _set_rate_limiter(rate_limiter):
+    global _rate_limiter
+    _rate_limiter = rate_limiter
+
+
+register_process_state(__name__, get_rate_limiter, _set_rate_limiter)
+
+
+def get_outcome(status_code):
+    if status_code == 200:
+        return SUCCESS
+    if status_code in THROTTLE_STATUS_CODES:
+        return THROTTLED
+    return FAILED
+
+
+def get_retry_after(headers):
+    """
+    Seconds to wait as per the Retry-After header, given either in seconds or as an HTTP date.
+    """
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
+
+
+def get_backoff_delay(attempt, retry_after=None):
+    """
+    Full jitter exponential backoff for the given retry attempt (1 based), never shorter than Retry-After.
+    """
+    base = float(config.get('BACKOFF_BASE', 0.5))
+    cap = float(config.get('BACKOFF_CAP', 30))
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    return max(delay, retry_after or 0)
@@ -1,13 +1,17 @@
 import os
-from time import sleep
+from time import perf_counter, sleep
 
 import requests
 from urllib3 import disable_warnings
 from urllib3.exceptions import InsecureRequestWarning
 
 import scripts.logger_util as Logger
-from scripts.session_helper import SessionPool
-from scripts.utils import get_configuration
+from scripts.metrics import record_request
+from scripts.rate_limiter import FAILED, SUCCESS, THROTTLED, get_backoff_delay, get_outcome, get_rate_limiter, \
+    get_retry_after
+from scripts.response_cache import get_response_cache
+from scripts.session_helper import AuthError, SessionPool, create_public_session
+from scripts.utils import get_configuration, get_endpoint, loads_json
 
 disable_warnings(InsecureRequestWarning)
 
@@ -15,64 +19,140 @@ config = get_configuration()
 logger = Logger.get_logger(__name__)
 
 
+def _record_connections(session_obj):
+    new_connections, requests_sent = session_obj.pop_connection_counts()
+    SessionPool().record_connections(new_connections, max(0, requests_sent - new_connections))
+
+
 def get_data_from_url(url, headers):
-    session_obj = SessionPool().acquire()
-    max_retry = config['MAX_RETRY'] if isinstance(config['MAX_RETRY'], str) else int(config['MAX_RETRY'])
+    return _get_from_url(url, headers, loads_json, cached=True)
+
+
+def get_content_from_url(url, headers=None, session_obj=None):
+    """
+    Raw bytes of a url that is not part of the API, e.g. a listing image, with the given session of
+    create_public_session or one created for the call, never with the API credentials. These requests do not take rate
+    limiter slots and are retried IMAGE_MAX_RETRY times.
+    """
+    created = session_obj is None
+    if created:
+        session_obj = create_public_session()
+    try:
+        return _get_from_url(url, headers, lambda content: content, session_obj, rate_limited=False,
+                             max_retry=int(config.get('IMAGE_MAX_RETRY', 2)), endpoint='image')
+    finally:
+        if created:
+            session_obj.close()
+
+
+def _get_from_url(url, headers, parse, session_obj=None, rate_limited=True, max_retry=None, cached=False,
+                  endpoint=None):
+    endpoint = endpoint or get_endpoint(url)
+    cache = get_response_cache() if cached else None
+    cached_response = cache.get(url) if cache is not None else None
+    if cache is not None and cache.is_usable(cached_response):
+        if cached_response is None:
+            logger.error("Url {} is not in the response cache, PID - {}".format(url, os.getpid()))
+            return None
+        return parse(cached_response.content)
+    if cached_response is not None:
+        headers = dict(headers or {}, **cached_response.get_conditional_headers())
+
+    acquired = session_obj is None
+    if acquired:
+        session_obj = SessionPool().acquire()
+    if max_retry is None:
+        max_retry = config['MAX_RETRY'] if isinstance(config['MAX_RETRY'], str) else int(config['MAX_RETRY'])
 
     retry = max_retry
     data = None
+    rate_limiter = get_rate_limiter()
 
     while retry:
         pid = os.getpid()
         if retry < max_retry:
             logger.debug(
                 "Retrying url {}...Already retired {} times, Max retry {}".format(url, max_retry - retry, max_retry))
-        with session_obj.session as session:
-            try:
-                req = requests.Request(method='GET', url=url, headers=headers)
-                prepped = session.prepare_request(req)
-
-                # Merge environment settings into session
-                settings = session.merge_environment_settings(prepped.url, {}, None, False, None)
-
-                if config['PROXY']:
-                    res = session.send(prepped, timeout=10, **settings)
-                else:
-                    res = session.send(prepped, timeout=10)
-
-                if res.status_code != 200:
-                    logger.error(
-                        "Error occurred while getting data from url - {}, PID - {}\nResposne code - {}"
-                            .format(url, pid, res.status_code))
-                else:
-                    if retry < max_retry:
-                        logger.debug(("Retry successful... for {} url, PID - {}, after retrying {} times"
-                                      ).format(url, pid, max_retry - retry))
-                    data = res.json()
-                    break
-            except requests.ConnectionError as e:
-                logger.error(("OOPS!! Connection Error while accessing url - {}, PID - {}." +
-                              " Make sure you are connected to Internet." +
-                              " Technical Details given below.\n").format(url, pid))
-                logger.error(str(e))
-            except requests.Timeout as e:
-                logger.error(
-                    "OOPS!! Timeout Error while accessing url - {}, PID - {}.Technical Details given below.\n".format(
-                        url, pid))
-                logger.error(str(e))
-            except requests.RequestException as e:
-                logger.error(
-                    ("OOPS!! Request Exception while accessing url - {}, PID - {}.Technical Details given below.\n"
-                     ).format(url, pid))
-                logger.error(str(e))
-            except Exception as e:
+        if acquired and not SessionPool().is_healthy(session_obj):
+            # Retry on a fresh session and connections instead of the one that keeps failing
+            SessionPool().release(session_obj)
+            session_obj = SessionPool().acquire()
+        session = session_obj.session
+        outcome = FAILED
+        retry_after = None
+        status_code = None
+        if rate_limited:
+            rate_limiter.acquire()
+        start_time = perf_counter()
+        try:
+            req = requests.Request(method='GET', url=url, headers=headers)
+            prepped = session.prepare_request(req)
+
+            # Merge environment settings into session
+            settings = session.merge_environment_settings(prepped.url, {}, None, False, None)
+
+            if config['PROXY']:
+                res = session.send(prepped, timeout=10, **settings)
+            else:
+                res = session.send(prepped, timeout=10)
+            status_code = res.status_code
+            _record_connections(session_obj)
+            outcome = get_outcome(res.status_code)
+            retry_after = get_retry_after(res.headers)
+
+            if res.status_code == 304 and cached_response is not None:
+                outcome = SUCCESS
+                cache.refresh(url)
+                data = parse(cached_response.content)
+                break
+            elif res.status_code != 200:
                 logger.error(
-                    ("OOPS!! General Exception while accessing url - {}, PID - {}.Technical Details given below.\n"
-                     ).format(url, pid))
-                logger.error(str(e))
+                    "Error occurred while getting data from url - {}, PID - {}\nResposne code - {}"
+                        .format(url, pid, res.status_code))
+                if res.status_code == 401:
+                    session_obj.update_auth()
+            else:
+                if retry < max_retry:
+                    logger.debug(("Retry successful... for {} url, PID - {}, after retrying {} times"
+                                  ).format(url, pid, max_retry - retry))
+                data = parse(res.content)
+                if cache is not None:
+                    cache.put(url, res.headers, res.content)
+                break
+        except requests.ConnectionError as e:
+            logger.error(("OOPS!! Connection Error while accessing url - {}, PID - {}." +
+                          " Make sure you are connected to Internet." +
+                          " Technical Details given below.\n").format(url, pid))
+            logger.error(str(e))
+        except requests.Timeout as e:
+            outcome = THROTTLED
+            logger.error(
+                "OOPS!! Timeout Error while accessing url - {}, PID - {}.Technical Details given below.\n".format(
+                    url, pid))
+            logger.error(str(e))
+        except requests.RequestException as e:
+            logger.error(
+                ("OOPS!! Request Exception while accessing url - {}, PID - {}.Technical Details given below.\n"
+                 ).format(url, pid))
+            logger.error(str(e))
+        except AuthError:
+            # Retrying can not help without a token, the crawl has failed
+            raise
+        except Exception as e:
+            logger.error(
+                ("OOPS!! General Exception while accessing url - {}, PID - {}.Technical Details given below.\n"
+                 ).format(url, pid))
+            logger.error(str(e))
+        finally:
+            session_obj.record_result(status_code is not None)
+            record_request(endpoint, status_code, perf_counter() - start_time, retry < max_retry)
+            if rate_limited:
+                rate_limiter.release(outcome, retry_after)
 
-        sleep(2)  # Sleeping for 2 sec before retrying again
         retry -= 1
+        if retry:
+            sleep(get_backoff_delay(max_retry - retry, retry_after))  # Backing off with jitter before retrying again
 
-    SessionPool().release(session_obj)
+    if acquired:
+        SessionPool().release(session_obj)
     return data
@@ -0,0 +1,153 @@
+import os
+import sqlite3
+import zlib
+from time import time
+
+import scripts.logger_util as Logger
+from scripts.utils import get_configuration, get_endpoint, register_process_state
+
+logger = Logger.get_logger(__name__)
+
+# Seconds a cached response is used without asking the server, per endpoint class
+DEFAULT_TTLS = {'market': 24 * 60 * 60, 'listing': 60 * 60}
+
+_response_cache = None
+
+
+def enable_response_cache(offline=False):
+    """
+    Cache the API responses of this process and of the worker processes started after this call.
+    With offline every response comes from the cache, urls that are not cached are treated as failed requests.
+    """
+    global _response_cache
+    _response_cache = ResponseCache(offline)
+    return _response_cache
+
+
+def get_response_cache():
+    return _response_cache
+
+
+def _set_response_cache(response_cache):
+    global _response_cache
+    _response_cache = response_cache
+
+
+register_process_state(__name__, get_response_cache, _set_response_cache)
+
+
+def is_offline():
+    """
+    True while replaying from the response cache, nothing may authenticate or open a connection to the API.
+    """
+    return _response_cache is not None and _response_cache.offline
+
+
+class CachedResponse:
+
+    def __init__(self, content, etag, last_modified, fresh):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh = fresh
+
+    def get_conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    On disk cache of API response bodies keyed by url, zlib compressed in one sqlite file shared by every process.
+
+    A response younger than the TTL of its endpoint class is used as is, an older one is revalidated with
+    If-None-Match / If-Modified-Since. The least recently used responses are evicted once the bodies take more than
+    RESPONSE_CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, offline=False):
+        config = get_configuration()
+        self.offline = offline
+        self.file_name = config.get('RESPONSE_CACHE_FILE', config['DOWNLOAD_LOCATION'] + '.cache/responses.sqlite')
+        self.__ttls = dict(DEFAULT_TTLS, **config.get('RESPONSE_CACHE_TTL', {}))
+        self.__max_bytes = int(config.get('RESPONSE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+        self.__compression_level = int(config.get('RESPONSE_CACHE_COMPRESSION_LEVEL', 6))
+        self.__connection = None
+        self.__pid = None
+        self.__puts = 0
+        cache_dir = os.path.dirname(self.file_name)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.__get_connection()
+        logger.info('Using response cache {}{}'.format(self.file_name, ', offline' if offline else ''))
+
+    def __getstate__(self):
+        # Spawned workers get the cache pickled, they open their own connection on first use
+        state = dict(self.__dict__)
+        state['_ResponseCache__connection'] = None
+        state['_ResponseCache__pid'] = None
+        return state
+
+    def is_usable(self, cached_response):
+        """
+        True when a request should be answered from the cache without asking the server.
+        """
+        return self.offline or (cached_response is not None and cached_response.fresh)
+
+    def get(self, url):
+        connection = self.__get_connection()
+        row = connection.execute('SELECT body, etag, last_modified, stored_at FROM responses WHERE url = ?',
+                                 (url,)).fetchone()
+        if row is None:
+            return None
+        connection.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time(), url))
+        body, etag, last_modified, stored_at = row
+        fresh = time() - stored_at < self.__ttls[get_endpoint(url)]
+        return CachedResponse(zlib.decompress(body), etag, last_modified, fresh)
+
+    def put(self, url, headers, content):
+        body = zlib.compress(content, self.__compression_level)
+        now = time()
+        connection = self.__get_connection()
+        connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (url, headers.get('ETag'), headers.get('Last-Modified'), body, len(body), now, now))
+        self.__puts += 1
+        if self.__puts % 64 == 0:
+            self.__evict()
+
+    def refresh(self, url):
+        """
+        Mark a response as fresh again after the server answered 304 Not Modified.
+        """
+        now = time()
+        self.__get_connection().execute('UPDATE responses SET stored_at = ?, accessed_at = ? WHERE url = ?',
+                                        (now, now, url))
+
+    def __evict(self):
+        connection = self.__get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if total <= self.__max_bytes:
+                return
+            # Keep the most recently used responses up to 90% of the limit
+            evicted = connection.execute('DELETE FROM responses WHERE url IN (SELECT url FROM '
+                                         '(SELECT url, SUM(size) OVER (ORDER BY accessed_at DESC) AS kept '
+                                         'FROM responses) WHERE kept > ?)', (self.__max_bytes * 0.9,)).rowcount
+        logger.info('Evicted {} least recently used responses from {}'.format(evicted, self.file_name))
+
+    def __get_connection(self):
+        # A sqlite connection must not cross a fork, every worker process opens its own
+        if self.__pid != os.getpid():
+            self.__connection = sqlite3.connect(self.file_name, timeout=60, isolation_level=None)
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute('PRAGMA synchronous=NORMAL')
+            self.__connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                      '(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body BLOB NOT NULL, '
+                                      'size INTEGER NOT NULL, stored_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+            self.__pid = os.getpid()
+        return self.__connection
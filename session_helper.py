@@ -1,21 +1,22 @@
-import platform
-import sys
+import os
+import threading
 import uuid
-from datetime import datetime
-from multiprocessing import Queue, Event
+from collections import deque
+from multiprocessing import Array, Lock, Value
+from multiprocessing.util import Finalize
 from pprint import pprint
-from queue import Empty as QueueEmpty
-from queue import Full as QueueFull
-from time import sleep
+from time import perf_counter, sleep, time
 
 import requests
-from apscheduler.schedulers.background import BackgroundScheduler
 from requests.adapters import HTTPAdapter
 from urllib3 import disable_warnings
 from urllib3.exceptions import InsecureRequestWarning
 from urllib3.util.retry import Retry
 
 import scripts.logger_util as Logger
+from scripts.metrics import (AUTH_REFRESH_SECONDS, CONNECTIONS, SESSION_CREATE_SECONDS, SESSION_POOL_SIZE,
+                             SESSIONS_EVICTED, SESSIONS_IN_USE)
+from scripts.rate_limiter import get_backoff_delay
 from scripts.utils import *
 
 disable_warnings(InsecureRequestWarning)
@@ -23,6 +24,16 @@ disable_warnings(InsecureRequestWarning)
 config = get_configuration()
 logger = Logger.get_logger(__name__)
 
+# Token, expiry, version, the last version that could not be replaced and the locks of the auth broker, one block of
+# shared memory for every process of the crawl
+_auth_state = None
+
+
+class AuthError(Exception):
+    """
+    The auth token could not be fetched or replaced, no request to the API can succeed any more.
+    """
+
 
 def _singleton(cls):
     instances = {}
@@ -35,41 +46,192 @@ def _singleton(cls):
     return get_instance
 
 
-class _RequestsRetrySession:
-    def __init__(self, retries=3, backoff_factor=1, status_forcelist=(500, 502, 504)):
-        self.session = self.__create_session(retries, backoff_factor, status_forcelist)
-        self.update_auth()
-
-    @staticmethod
-    def __create_session(retries, backoff_factor, status_forcelist):
-        s = requests.Session()
-        retry = Retry(
-            total=retries,
-            read=retries,
-            connect=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=status_forcelist,
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        s.mount('http://', adapter)
-        s.mount('https://', adapter)
-        s.verify = False
-        s.keep_alive = True
+def _create_session(retries, backoff_factor, status_forcelist, connection_retries=None, cookies=True):
+    s = requests.Session()
+    connection_retries = retries if connection_retries is None else connection_retries
+    retry = Retry(
+        total=retries,
+        read=connection_retries,
+        connect=connection_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+    )
+    adapter = HTTPAdapter(pool_connections=int(config.get('POOL_CONNECTIONS', 10)),
+                          pool_maxsize=int(config.get('POOL_MAXSIZE', 10)),
+                          max_retries=retry)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    s.verify = False
+    s.keep_alive = True
+    if cookies:
         s.cookies.update(get_cookies())
-        s.headers.update({
-            'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_1) AppleWebKit/537.36 (KHTML, like Gecko) '
-                          'Chrome/70.0.3538.110 Safari/537.36',
-            'accept': '*/*',
-            'accept-encoding': 'gzip, deflate, br',
-            'accept-language': 'en-US,en;q=0.9',
-            'origin': 'https://udaan.com',
-            'authority': 'api.udaan.com',
-            'scheme': 'https',
-            'upgrade-insecure-requests': '1',
-        })
-        return s
+    s.headers.update({
+        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_1) AppleWebKit/537.36 (KHTML, like Gecko) '
+                      'Chrome/70.0.3538.110 Safari/537.36',
+        'accept': '*/*',
+        'accept-encoding': 'gzip, deflate, br',
+        'accept-language': 'en-US,en;q=0.9',
+        'origin': 'https://udaan.com',
+        'authority': 'api.udaan.com',
+        'scheme': 'https',
+        'upgrade-insecure-requests': '1',
+    })
+    return s
+
+
+class _RequestsRetrySession:
+    # Status, timeout and connection retries are left to get_data_from_url, so every failed attempt is seen by the
+    # shared rate limiter and backs off with it
+    def __init__(self, retries=3, backoff_factor=1, status_forcelist=(), auth=True):
+        self.id = uuid.uuid4()
+        self.session = _create_session(retries, backoff_factor, status_forcelist, 0, cookies=auth)
+        self.errors = 0
+        self.__counts = 0, 0
+        self.__counts_lock = threading.Lock()
+        self.__auth = auth
+        self.__auth_version = None
+        self.apply_auth()
+
+    def record_result(self, healthy):
+        """
+        Count connection level errors in a row, any response from the server resets the count.
+        """
+        self.errors = 0 if healthy else self.errors + 1
+
+    def close(self):
+        self.session.close()
+
+    def pop_connection_counts(self):
+        """
+        Returns (new connections, requests sent) over all urllib3 connection pools of this session since the previous
+        call. Threads sharing the session each get their own part of the totals.
+        """
+        with self.__counts_lock:
+            new_connections = 0
+            requests_sent = 0
+            for adapter in set(self.session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        new_connections += pool.num_connections
+                        requests_sent += pool.num_requests
+            counts = new_connections - self.__counts[0], requests_sent - self.__counts[1]
+            self.__counts = new_connections, requests_sent
+            return counts
 
     def update_auth(self):
+        if not self.__auth:
+            return
+        _AuthBroker().refresh(self.__auth_version)
+        self.apply_auth()
+
+    def apply_auth(self):
+        if not self.__auth:
+            return
+        auth_version, auth_token = _AuthBroker().get_auth()
+        if auth_version != self.__auth_version:
+            self.session.headers.update({
+                'Authorization': auth_token,
+            })
+            self.__auth_version = auth_version
+
+
+def _get_auth_state():
+    global _auth_state
+    if _auth_state is None:
+        _auth_state = (Array('c', 8192, lock=False), Value('d', 0.0, lock=False), Value('L', 0, lock=False),
+                       Value('l', -1, lock=False), Lock(), Lock())
+    return _auth_state
+
+
+def _set_auth_state(state):
+    global _auth_state
+    _auth_state = state
+
+
+register_process_state(__name__, _get_auth_state, _set_auth_state)
+
+
+@_singleton
+class _AuthBroker:
+    """
+    Single owner of the bearer token. The token lives in shared memory handed to every worker process by
+    get_process_pool, so one auth round-trip serves every session in every process.
+    """
+
+    def __init__(self):
+        self.__sessions = {}
+        self.__refresh_interval = float(config.get('AUTH_REFRESH_INTERVAL', 500))
+        self.__refresh_margin = float(config.get('AUTH_REFRESH_MARGIN', 60))
+        (self.__token, self.__expires_at, self.__version, self.__failed_version, self.__refresh_lock,
+         self.__token_lock) = _get_auth_state()
+        # Only the first broker of the crawl fetches a token, the others find it published already
+        self.refresh(0)
+
+    def get_version(self):
+        return self.__version.value
+
+    def get_auth(self):
+        """
+        Returns (version, Authorization header value), refreshing first only if the token has already expired.
+        """
+        with self.__token_lock:
+            auth = self.__version.value, self.__token.value.decode('utf-8')
+            expired = self.__expires_at.value <= time()
+        if expired:
+            self.refresh(auth[0])
+            return self.get_auth()
+        return auth
+
+    def refresh_if_expiring(self):
+        with self.__token_lock:
+            version = self.__version.value
+            expiring = self.__expires_at.value - self.__refresh_margin <= time()
+        if expiring:
+            try:
+                self.refresh(version, retry_failed=True)
+            except AuthError as e:
+                logger.error('{}, trying again on the next check'.format(e))
+
+    def refresh(self, stale_version=None, retry_failed=False):
+        """
+        Fetch a new token. When stale_version is given the refresh is skipped if another process or session has
+        already replaced that version, so concurrent callers seeing the same expired token trigger one round-trip.
+
+        Raises AuthError when no token could be fetched in MAX_RETRY attempts. The version stays failed for every
+        process, later callers holding it raise at once instead of retrying, unless retry_failed is set.
+        """
+        with self.__refresh_lock:
+            if stale_version is not None and stale_version != self.__version.value:
+                return
+            if stale_version == self.__failed_version.value and not retry_failed:
+                raise AuthError('Auth token version {} could not be replaced'.format(stale_version))
+            start_time = perf_counter()
+            try:
+                self.__update_auth()
+            except AuthError:
+                if stale_version is not None:
+                    self.__failed_version.value = stale_version
+                raise
+            finally:
+                AUTH_REFRESH_SECONDS.observe(perf_counter() - start_time)
+
+    def __get_session(self):
+        # Connections must not be shared with the process this broker was forked from
+        pid = os.getpid()
+        if pid not in self.__sessions:
+            self.__sessions[pid] = _create_session(3, 1, (500, 502, 504))
+        return self.__sessions[pid]
+
+    def __publish(self, auth_token, expires_in):
+        with self.__token_lock:
+            self.__token.value = auth_token.encode('utf-8')
+            self.__expires_at.value = time() + expires_in
+            self.__version.value += 1
+        logger.info('Published auth token version {} valid for {} seconds'.format(self.__version.value, expires_in))
+
+    def __update_auth(self):
         max_retry = config['MAX_RETRY'] if isinstance(config['MAX_RETRY'], str) else int(config['MAX_RETRY'])
         retry = max_retry
 
@@ -93,17 +255,18 @@ class _RequestsRetrySession:
                 'x-csrf-token': csrf_token
             })
 
+            session = self.__get_session()
             req = requests.Request(method='POST', url=url, data='u=-1', headers=headers)
-            prepped = self.session.prepare_request(req)
+            prepped = session.prepare_request(req)
             # Merge environment settings into session
-            settings = self.session.merge_environment_settings(prepped.url, {}, None, False, None)
+            settings = session.merge_environment_settings(prepped.url, {}, None, False, None)
 
             # pprint(prepped.__dict__)
             try:
                 if config['PROXY']:
-                    res = self.session.send(prepped, **settings)
+                    res = session.send(prepped, **settings)
                 else:
-                    res = self.session.send(prepped)
+                    res = session.send(prepped)
                 if res.status_code != 200:
                     error_message = ("OOPS!! Error occurred while getting auth data from url - {}" +
                                      ", request Id - {}.\nResponse code - {}\nResponse  - {}").format(url,
@@ -116,9 +279,8 @@ class _RequestsRetrySession:
                         auth_res = res.json()
                         token_type = auth_res.get('token_type', "Bearer")
                         auth_token = token_type + " " + auth_res['accessToken']
-                        self.session.headers.update({
-                            'Authorization': auth_token,
-                        })
+                        expires_in = auth_res.get('expires_in', auth_res.get('expiresIn'))
+                        self.__publish(auth_token, float(expires_in) if expires_in else self.__refresh_interval)
                         updated = True
                         break
                     except Exception as e:
@@ -155,111 +317,112 @@ class _RequestsRetrySession:
                     "Technical Details given below.\n".format(url, request_id))
                 logger.error(str(e))
 
-            sleep(2)  # Sleeping for 2 sec before retrying again
             retry -= 1
+            if retry:
+                sleep(get_backoff_delay(max_retry - retry))  # Backing off with jitter before retrying again
 
         if not updated:
-            logger.error(
-                "Auth could not be updated for request Id - {}, hence terminating the service".format(request_id))
-            sys.exit(status="Auth could not be updated")
+            raise AuthError("Auth could not be updated for request Id - {}".format(request_id))
 
 
 @_singleton
 class SessionPool:
     """
-    Manage Reusable objects for use by Client objects.
+    Per process pool of requests sessions that never blocks. Sessions stay in the process that created them so their
+    keep-alive connections are reused; acquire hands out an idle session or creates one, and at most SESSION_POOL_SIZE
+    idle sessions are kept. Sessions pick up the shared auth token in place when acquired, so a token refresh never
+    waits for the pool. A session failing SESSION_MAX_ERRORS requests in a row at the connection level is closed and
+    replaced.
     """
 
     def __init__(self):
-        self.__event = Event()
-        self.__event.set()
+        _AuthBroker()
 
-        self.__session_queue_size = config['NUM_OF_WORKER_PROCESS']
-        self.__session_queue = Queue(self.__session_queue_size)
-        session_list = [_RequestsRetrySession() for _ in range(self.__session_queue_size)]
-        self.__insert_list_items_in_queue(session_list)
+        self.__max_idle = int(config.get('SESSION_POOL_SIZE', 4))
+        self.__max_errors = int(config.get('SESSION_MAX_ERRORS', 3))
+        self.__pid = None
+        self.__idle = None
+        self.__in_use = None
 
     def acquire(self):
-        if not self.__event.is_set():
-            self.__event.wait()
-
-        return self.__session_queue.get()
+        try:
+            # LIFO, the most recently used session is the most likely to still hold open connections
+            session_obj = self.__get_idle().pop()
+        except IndexError:
+            start_time = perf_counter()
+            session_obj = _RequestsRetrySession()
+            SESSION_CREATE_SECONDS.observe(perf_counter() - start_time)
+            SESSION_POOL_SIZE.inc()
+        self.__in_use.add(session_obj.id)
+        SESSIONS_IN_USE.inc()
+        session_obj.apply_auth()
+        return session_obj
 
     def release(self, session_obj):
-        if isinstance(session_obj, _RequestsRetrySession):
-            try:
-                self.__session_queue.put(session_obj)
-
-            except QueueFull:
-                logger.warn('Unable to push into queue at {}, as Queue is Full'.format(datetime.now()))
-                pass
-        else:
-            logger.warn(
-                'Receive object is not session object, receive object is of {},' +
-                ' Creating a new session and storing in queue'.format(type(session_obj)))
-            self.__session_queue.put(_RequestsRetrySession())
-
-    def trigger_update_auth(self):
-        logger.debug('Received event for refresh auth token at {}'.format(datetime.now()))
-        self.__lock_on_acquire()
-        if not self.__session_queue.full():
-            if platform.system() == "Darwin":
-                __queue_size = self.__session_queue_size
-            else:
-                __queue_size = self.__session_queue.qsize()
-            logger.info('Session pool is not full on {}, there are only {} session out of {}'
-                        .format(datetime.now(), self.__get_current_pool_size(), __queue_size))
-            set_timeout(5.0, self.trigger_update_auth)
+        idle = self.__get_idle()
+        self.__in_use.discard(session_obj.id)
+        SESSIONS_IN_USE.dec()
+        if not self.is_healthy(session_obj):
+            logger.warning('Evicting session {} after {} connection errors in a row, PID - {}'
+                           .format(session_obj.id, session_obj.errors, os.getpid()))
+            SESSIONS_EVICTED.inc()
+            SESSION_POOL_SIZE.dec()
+            session_obj.close()
+        elif len(idle) < self.__max_idle:
+            idle.append(session_obj)
         else:
-            session_list = []
-            logger.info('All session are there in Session pool on {}. Hence triggering update for all session'
-                        .format(datetime.now()))
-            for sessionObj in self.__get_all():
-                sessionObj.update_auth()
-                session_list.append(sessionObj)
-
-            self.__insert_list_items_in_queue(session_list)
-            self.__release_lock_on_acquire()
-            logger.info('Successfully refreshed auth token for {} sessions at {}'
-                        .format(len(session_list), datetime.now()))
-
-    def __insert_list_items_in_queue(self, l):
-        for s in l:
-            try:
-                self.__session_queue.put(s)
-            except QueueFull:
-                break
-
-    def __lock_on_acquire(self):
-        self.__event.clear()  # set internal flag to false
-
-    def __release_lock_on_acquire(self):
-        self.__event.set()  # set internal flag to true
-
-    def __get_current_pool_size(self):
-        session_list = []
-        for session in self.__get_all():
-            session_list.append(session)
-        current_pool_size = len(session_list)
-        self.__insert_list_items_in_queue(session_list)
-        return current_pool_size
-
-    def __get_all(self):
-        while True:
-            try:
-                result = self.__session_queue.get(block=False)
-                yield result
-            except QueueEmpty:
-                break
+            SESSION_POOL_SIZE.dec()
+            session_obj.close()
+
+    def is_healthy(self, session_obj):
+        return session_obj.errors < self.__max_errors
+
+    def get_state(self):
+        """
+        Returns (sessions, sessions in use) of this process, the crawler_session_pool_size and crawler_sessions_in_use
+        gauges add up every process.
+        """
+        idle = self.__get_idle()
+        in_use = len(self.__in_use)
+        return len(idle) + in_use, in_use
+
+    def record_connections(self, new_connections, reused_connections):
+        CONNECTIONS.inc('new', amount=new_connections)
+        CONNECTIONS.inc('reused', amount=reused_connections)
+
+    def get_connection_counts(self):
+        """
+        Returns (new, reused) connection counts across every process.
+        """
+        return int(CONNECTIONS.get('new')), int(CONNECTIONS.get('reused'))
+
+    def __get_idle(self):
+        # A forked worker inherits the pool object but not the sockets of its sessions, it starts an empty pool
+        if self.__pid != os.getpid():
+            self.__idle = deque()
+            self.__in_use = set()
+            self.__pid = os.getpid()
+            # The pool engine starts new worker processes per sub category, the sessions of an exiting process leave
+            # the gauges with it
+            Finalize(None, _remove_sessions, args=(self.__idle, self.__in_use), exitpriority=0)
+        return self.__idle
+
+
+def _remove_sessions(idle, in_use):
+    SESSION_POOL_SIZE.dec(amount=len(idle) + len(in_use))
+    SESSIONS_IN_USE.dec(amount=len(in_use))
 
 
 @_singleton
 class _AuthUpdateScheduler:
 
     def __init__(self):
+        # Only the parent runs the auth updater, workers never pay for importing apscheduler
+        from apscheduler.schedulers.background import BackgroundScheduler
+
         self.__stop = False
         self.__job_scheduler = BackgroundScheduler()
-        self.__job_scheduler.add_job(SessionPool().trigger_update_auth, 'interval', seconds=500, misfire_grace_time=50)
+        self.__job_scheduler.add_job(_AuthBroker().refresh_if_expiring, 'interval', seconds=30, misfire_grace_time=30)
 
         self.__monitoring_scheduler = BackgroundScheduler()
         self.__monitoring_scheduler.add_job(self.check_progress, 'interval', seconds=20, misfire_grace_time=20)
@@ -279,6 +442,36 @@ class _AuthUpdateScheduler:
         self.__stop = True
 
 
+def create_public_session():
+    """
+    Session for urls outside of the API, e.g. listing images on a CDN. It never carries the API cookies or the bearer
+    token, whatever host it is sent to.
+    """
+    return _RequestsRetrySession(auth=False)
+
+
+def get_auth_version():
+    """
+    Version of the shared auth token, it changes with every refresh.
+    """
+    return _AuthBroker().get_version()
+
+
+def get_auth():
+    """
+    Returns (version, Authorization header value) of the shared auth token.
+    """
+    return _AuthBroker().get_auth()
+
+
+def refresh_auth(stale_version):
+    """
+    Replace the token of the given version after the API rejected it, unless another process already did. Raises
+    AuthError when it can not be replaced.
+    """
+    _AuthBroker().refresh(stale_version)
+
+
 def start_auth_updater():
     _AuthUpdateScheduler().start()
 
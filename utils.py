@@ -1,9 +1,18 @@
+import importlib
 import json
+import os
 import ssl
 import threading
+from multiprocessing import Pool
 from http import cookiejar
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 
+try:
+    from orjson import loads as loads_json
+except ImportError:
+    # orjson is optional, it decodes listing pages about twice as fast as the standard library
+    from json import loads as loads_json
+
 try:
     _create_unverified_https_context = ssl._create_unverified_context
 except AttributeError:
@@ -14,16 +23,107 @@ else:
     ssl._create_default_https_context = _create_unverified_https_context
 
 CONFIG_FILE_LOC = 'config/config.json'
+# Environment variables named CRAWLER_<KEY> override the KEY of the config file
+ENV_PREFIX = 'CRAWLER_'
+# Listings per page the API returns when it is not asked for a page size
+DEFAULT_PAGE_SIZE = 12
+
+
+class Settings:
+    """
+    Runtime settings of the crawl, the config file overridden by CRAWLER_<KEY> environment variables and then by the
+    command line through update. The file is read once, on first use, and never written back.
+
+    Pools created with get_process_pool and workers started with init_process get the values of the parent as an
+    argument, so no worker reads the file again.
+    """
+
+    def __init__(self):
+        self.__values = None
+
+    def __getitem__(self, key):
+        return self.__get_values()[key]
+
+    def __contains__(self, key):
+        return key in self.__get_values()
+
+    def get(self, key, default=None):
+        return self.__get_values().get(key, default)
+
+    def update(self, values):
+        self.__get_values().update(values)
+
+    def get_values(self):
+        return dict(self.__get_values())
+
+    def set_values(self, values):
+        self.__values = dict(values)
+
+    def __get_values(self):
+        if self.__values is None:
+            with open(CONFIG_FILE_LOC, 'r') as f:
+                values = json.load(f)
+            values.update(get_env_settings())
+            self.__values = values
+        return self.__values
+
+
+_settings = Settings()
 
 
 def get_configuration():
-    with open(CONFIG_FILE_LOC, 'r') as f:
-        return json.load(f)
+    return _settings
+
 
+def get_env_settings():
+    """
+    CRAWLER_<KEY> environment variables as settings, values that parse as json (numbers, booleans, objects) are
+    decoded, anything else is kept as text.
+    """
+    values = {}
+    for name, value in os.environ.items():
+        if name.startswith(ENV_PREFIX) and len(name) > len(ENV_PREFIX):
+            try:
+                values[name[len(ENV_PREFIX):]] = json.loads(value)
+            except ValueError:
+                values[name[len(ENV_PREFIX):]] = value
+    return values
 
-def update_configuration(c):
-    with open(CONFIG_FILE_LOC, 'w') as f:
-        f.write(json.dumps(c, indent=2))
+
+# Module name -> (get_state, set_state) of the modules whose state the worker processes need from the parent
+_process_states = {}
+
+
+def register_process_state(name, get_state, set_state):
+    """
+    Hand state of a module, e.g. its shared memory, to the worker processes. get_state() runs in the parent when a pool
+    is created and set_state(state) in every worker before its first task, so workers see the same state whether they
+    are forked or spawned.
+    """
+    _process_states[name] = (get_state, set_state)
+
+
+def get_process_state():
+    """
+    Settings and registered module state of this process, the argument of init_process.
+    """
+    return _settings.get_values(), dict((name, get_state()) for name, (get_state, _) in _process_states.items())
+
+
+def init_process(state):
+    """
+    Process initializer, installs the settings and the module state of the parent process in a worker.
+    """
+    values, module_states = state
+    _settings.set_values(values)
+    for name, module_state in module_states.items():
+        # A spawned worker has not imported the module yet, importing it registers its state
+        importlib.import_module(name)
+        _process_states[name][1](module_state)
+
+
+def get_process_pool(processes):
+    return Pool(processes=processes, initializer=init_process, initargs=(get_process_state(),))
 
 
 def get_cookies():
@@ -66,12 +166,35 @@ def set_query_field(url, field, value, replace=False):
     return urlunparse(new_components)
 
 
-def get_api_url(target_url, start_value):
+def get_api_url(target_url, start_value, page_size=None):
     search_url = target_url if target_url.startswith("/") else "/" + target_url
     if search_url[7:10] != '/v1':
         search_url = search_url[:7] + '/v1' + search_url[7:]
-    api_url = config['API_BASE_URL'] + search_url
-    return set_query_field(api_url, 'start_value', start_value, True)
+    api_url = set_query_field(config['API_BASE_URL'] + search_url, 'start_value', start_value, True)
+    page_size = page_size or get_page_size()
+    # Pages of the default size are asked for without the field, as the API always was, keeping their cache keys
+    if get_endpoint(api_url) == 'listing' and page_size != DEFAULT_PAGE_SIZE:
+        api_url = set_query_field(api_url, config.get('PAGE_SIZE_FIELD', 'rows'), page_size, True)
+    return api_url
+
+
+def get_endpoint(url):
+    """
+    Endpoint class of an API url, 'market' for the market tree and 'listing' for search pages.
+    """
+    return 'market' if urlparse(url).path.rstrip('/').endswith('/market/v1') else 'listing'
+
+
+def get_page_size():
+    """
+    Listings per page from the PAGE_SIZE setting, the default page size while 'auto' is not probed yet.
+    """
+    page_size = config.get('PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    return DEFAULT_PAGE_SIZE if page_size == 'auto' else int(page_size)
+
+
+def get_page_starts(items_found, page_size=None):
+    return list(range(0, items_found, page_size or get_page_size()))
 
 
 def set_timeout(interval, func, args=None, kwargs=None):
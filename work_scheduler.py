@@ -0,0 +1,217 @@
+import heapq
+from queue import Queue
+
+import scripts.logger_util as Logger
+from scripts.session_helper import AuthError
+from scripts.utils import *
+
+config = get_configuration()
+logger = Logger.get_logger(__name__)
+
+
+class _Target:
+
+    def __init__(self, target_url, sequence):
+        self.target_url = target_url
+        self.sequence = sequence
+        self.items_found = None
+        self.page_starts = None
+        self.pages = {}
+        self.next_page = 0
+        self.unchanged = False
+        self.begun = False
+        self.complete = True
+        self.fingerprint = None
+        self.items = []
+        self.done = False
+
+
+class _Category:
+
+    def __init__(self, sequence, checkpoint, index):
+        self.sequence = sequence
+        self.checkpoint = checkpoint
+        self.index = index
+        self.targets = []
+        self.attached = False
+        self.on_page = None
+
+
+class WorkScheduler:
+    """
+    Crawls the pages of every submitted category through one long lived process pool, fed from a single queue of
+    (target url, start_value) work items, so small sub categories do not leave workers idle in between.
+
+    Work items are dispatched in category order and at most `processes * SCHEDULER_PREFETCH` are in flight, so the
+    categories finish roughly in the order they are asked for while the next ones already keep the pool busy. Pages
+    are handed to the checkpoint as they arrive, but the index, on_page and the returned items only see them once
+    get_category_items_details is called for their category, in start_value order like the pool engine.
+
+    Categories of several markets can share one scheduler, each category is submitted with the checkpoint and index
+    of its market under a key that is unique across the markets.
+    """
+
+    def __init__(self, get_page, processes):
+        """
+        get_page(target_url, start_value) runs in the worker processes and returns (items found, items) or None.
+        """
+        self.__get_page = get_page
+        self.__pool = get_process_pool(processes)
+        self.__max_in_flight = processes * int(config.get('SCHEDULER_PREFETCH', 2))
+        self.__results = Queue()
+        self.__work = []
+        self.__in_flight = 0
+        self.__targets = {}
+        self.__categories = {}
+        self.__category_sequences = {}
+        self.__target_sequence = 0
+        self.__error = None
+
+    def submit(self, category_key, target_urls, checkpoint=None, index=None):
+        if category_key in self.__category_sequences:
+            return
+        category_sequence = len(self.__category_sequences)
+        category = _Category(category_sequence, checkpoint, index)
+        self.__category_sequences[category_key] = category_sequence
+        self.__categories[category_sequence] = category
+        for target_url in dict.fromkeys(target_urls):
+            target = _Target(target_url, self.__target_sequence)
+            self.__target_sequence += 1
+            self.__targets[(category_sequence, target_url)] = target
+            category.targets.append(target)
+
+            items_found = checkpoint.get_items_found(target_url) if checkpoint is not None else None
+            if items_found is None:
+                self.__push(category_sequence, target, 0)
+            else:
+                stored_pages = checkpoint.get_pages(target_url)
+                logger.info("Resuming '{}' with {} pages from checkpoint".format(target_url, len(stored_pages)))
+                self.__start_target(category, target, items_found, stored_pages)
+        self.__dispatch()
+
+    def get_category_items_details(self, category_key, on_page=None):
+        """
+        Waits for every target url of a submitted category, returns a dict of target url -> items, or None when the
+        first page of that target url could not be fetched. With on_page the items are passed to it page by page
+        instead and the returned lists are empty. Raises the AuthError of a worker once no page can be fetched.
+        """
+        category = self.__categories[self.__category_sequences[category_key]]
+        category.attached = True
+        category.on_page = on_page
+        for target in category.targets:
+            self.__emit(category, target)
+
+        while not all(target.done for target in category.targets):
+            self.__dispatch()
+            category_sequence, target_url, start_value, result = self.__results.get()
+            self.__in_flight -= 1
+            if self.__error is not None:
+                raise self.__error
+            self.__on_result(category_sequence, self.__targets[(category_sequence, target_url)], start_value, result)
+        self.__dispatch()
+
+        del self.__categories[category.sequence]
+        category_items_details = {}
+        for target in category.targets:
+            del self.__targets[(category.sequence, target.target_url)]
+            category_items_details[target.target_url] = target.items
+        logger.debug("'{}' category completed, {} work items in flight, {} queued"
+                     .format(category_key, self.__in_flight, len(self.__work)))
+        return category_items_details
+
+    def close(self):
+        # Every category has been collected, the workers are idle and exit once their log records are flushed
+        self.__pool.close()
+        self.__pool.join()
+
+    def __push(self, category_sequence, target, start_value):
+        heapq.heappush(self.__work, (category_sequence, target.sequence, start_value, target.target_url))
+
+    def __dispatch(self):
+        while self.__work and self.__in_flight < self.__max_in_flight:
+            category_sequence, _, start_value, target_url = heapq.heappop(self.__work)
+            self.__in_flight += 1
+            self.__pool.apply_async(
+                self.__get_page, (target_url, start_value),
+                callback=lambda result, key=(category_sequence, target_url, start_value):
+                self.__results.put(key + (result,)),
+                error_callback=lambda error, key=(category_sequence, target_url, start_value):
+                self.__on_error(key, error))
+
+    def __on_error(self, key, error):
+        logger.error('Failed to get page {} of {} - {}'.format(key[2], key[1], error))
+        if isinstance(error, AuthError):
+            # No page can be fetched any more, the crawl fails instead of writing empty categories
+            self.__error = error
+        self.__results.put(key + (None,))
+
+    def __on_result(self, category_sequence, target, start_value, result):
+        category = self.__categories[category_sequence]
+        checkpoint = category.checkpoint
+        if start_value == 0 and target.items_found is None:
+            if result is None:
+                target.items = None
+                target.done = True
+                return
+            items_found, items = result
+            logger.info("Getting data from '{}'".format(get_api_url(target.target_url, 0)))
+            if checkpoint is not None:
+                checkpoint.add_page(target.target_url, 0, items)
+                checkpoint.set_items_found(target.target_url, items_found)
+            self.__start_target(category, target, items_found, {0: items})
+        else:
+            if result is not None and checkpoint is not None:
+                checkpoint.add_page(target.target_url, start_value, result[1])
+            target.pages[start_value] = result[1] if result is not None else None
+        if category.attached:
+            self.__emit(category, target)
+
+    def __start_target(self, category, target, items_found, stored_pages):
+        logger.debug("Items Found - {} for '{}'".format(items_found, target.target_url))
+        target.items_found = items_found
+        target.page_starts = get_page_starts(items_found)
+        target.pages = dict((start_value, stored_pages[start_value]) for start_value in target.page_starts
+                            if start_value in stored_pages)
+        if category.index is not None:
+            target.fingerprint = category.index.get_fingerprint(stored_pages.get(0, []))
+            if category.index.is_unchanged(target.target_url, items_found, target.fingerprint):
+                target.unchanged = True
+                return
+        for start_value in target.page_starts:
+            if start_value not in target.pages:
+                self.__push(category.sequence, target, start_value)
+
+    def __emit(self, category, target):
+        if target.done or target.items_found is None:
+            return
+        index = category.index
+        if target.unchanged:
+            logger.info("'{}' is unchanged since the last crawl, reusing indexed items".format(target.target_url))
+            self.__add_items(category, target, index.get_items(target.target_url))
+            target.done = True
+            return
+
+        if index is not None and not target.begun:
+            index.begin(target.target_url)
+            target.begun = True
+        while target.next_page < len(target.page_starts) and target.page_starts[target.next_page] in target.pages:
+            items = target.pages.pop(target.page_starts[target.next_page])
+            target.next_page += 1
+            if items is None:
+                target.complete = False
+                continue
+            if index is not None:
+                index.add_items(target.target_url, items)
+            self.__add_items(category, target, items)
+        if target.next_page == len(target.page_starts):
+            if index is not None:
+                index.finish(target.target_url, target.items_found, target.fingerprint, target.complete)
+            logger.debug('Item Processed - {} for {}'.format(len(target.items), target.target_url))
+            target.done = True
+
+    @staticmethod
+    def __add_items(category, target, items):
+        if category.on_page is not None:
+            category.on_page(target.target_url, items)
+        else:
+            target.items += items
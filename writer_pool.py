@@ -0,0 +1,71 @@
+from threading import Condition
+from time import perf_counter
+
+import scripts.logger_util as Logger
+from scripts.metrics import WRITER_WAIT_SECONDS
+from scripts.utils import get_configuration, get_process_pool
+
+config = get_configuration()
+logger = Logger.get_logger(__name__)
+
+
+class WriterPool:
+    """
+    Runs output writes in a pool of writer processes, so pandas conversion and serialization use their own cores
+    instead of competing with the crawl for the GIL.
+
+    At most queue_size writes are queued or running. submit blocks the crawl while the writers are behind, which keeps
+    the items held in memory bounded by the queue instead of by the market.
+    """
+
+    def __init__(self, processes=None, queue_size=None):
+        processes = processes or int(config.get('NUM_OF_WRITER_PROCESS', 2))
+        self.__queue_size = queue_size or int(config.get('WRITER_QUEUE_SIZE', processes * 2))
+        self.__pool = get_process_pool(processes)
+        self.__condition = Condition()
+        self.__pending = 0
+        self.__failed = 0
+
+    def submit(self, func, args, on_done=None):
+        """
+        Run func(*args) in a writer process, on_done(result) is called in this process once it succeeded.
+        """
+        start_time = perf_counter()
+        with self.__condition:
+            while self.__pending >= self.__queue_size:
+                self.__condition.wait()
+            self.__pending += 1
+        WRITER_WAIT_SECONDS.observe(perf_counter() - start_time)
+
+        def callback(result):
+            try:
+                if on_done is not None:
+                    on_done(result)
+            finally:
+                self.__finish()
+
+        def error_callback(e):
+            logger.error('Write {}{} failed. Technical Details given below.\n{}'.format(func.__name__, args[:2], e))
+            self.__failed += 1
+            self.__finish()
+
+        self.__pool.apply_async(func, args, callback=callback, error_callback=error_callback)
+
+    def join(self):
+        """
+        Wait until every submitted write is done, returns the number of failed writes so far.
+        """
+        with self.__condition:
+            while self.__pending:
+                self.__condition.wait()
+        return self.__failed
+
+    def close(self):
+        self.join()
+        self.__pool.close()
+        self.__pool.join()
+
+    def __finish(self):
+        with self.__condition:
+            self.__pending -= 1
+            self.__condition.notify_all()